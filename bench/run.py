@@ -0,0 +1,106 @@
+import os, sys, json, time, shutil, socket, argparse, tempfile, tracemalloc, subprocess
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import preprocess
+from xdfio import load_xdf_cached, load_stream
+from filters import filter_data
+from profiling import peak_rss_mb
+from bench.synthetic import write_xdf
+
+SIZES = {'10m': 600, '1h': 3600, '4h': 14400}  # Session lengths in seconds
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.json')
+
+def measure(name, size, fn):
+    # Wall time, CPU time and peak traced allocation (numpy buffers included) of one stage
+    tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = fn()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    row = {'stage': name, 'size': size, 'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3),
+           'peak_mb': round(peak / 1024 ** 2, 1), 'max_rss_mb': peak_rss_mb()}
+    print(f"{size:>4} {name:<12} {row['wall_s']:>9.3f} s {row['peak_mb']:>9.1f} MB")
+    return row, result
+
+def run_size(size, seconds, workdir, n_channels):
+    rows = []
+    file_path = os.path.join(workdir, f'sub-999_bench-{size}_eeg.xdf')
+    events = write_xdf(file_path, seconds, n_channels=n_channels)
+    events_df = pd.DataFrame(events, columns=['onset', 'duration', 'event_id'])
+
+    row, _ = measure('load_stream', size, lambda: load_stream(file_path, 'EEG', channels=range(4)))
+    rows.append(row)
+    row, _ = measure('cache_build', size, lambda: load_xdf_cached(file_path))
+    rows.append(row)
+    row, _ = measure('cache_load', size, lambda: load_xdf_cached(file_path))
+    rows.append(row)
+    row, (raw, sfreq) = measure('load', size, lambda: preprocess.load_eeg_data(file_path))
+    rows.append(row)
+
+    data = raw.get_data()
+    for method in ('fir', 'iir'):
+        row, _ = measure(f'filter_{method}', size,
+                         lambda: filter_data(data.copy(), sfreq, preprocess.HIGHPASS, preprocess.LOWPASS, method))
+        rows.append(row)
+    raw.apply_function(lambda x: filter_data(x, sfreq, preprocess.HIGHPASS, preprocess.LOWPASS, out=x),
+                       channel_wise=False)
+
+    row, _ = measure('epoch', size, lambda: preprocess.epoch_events(raw._data, sfreq, events_df))
+    rows.append(row)
+    row, _ = measure('ica', size, lambda: preprocess.fit_ica(raw))
+    rows.append(row)
+    deriv_root = os.path.join(workdir, 'derivatives')
+    row, _ = measure('events', size, lambda: preprocess.preprocess_events(raw, sfreq, events_df, '999',
+                                                                          f'bench-{size}', deriv_root))
+    rows.append(row)
+    return rows
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(HISTORY_FILE)).stdout.strip()
+    except OSError:
+        return ''
+
+def append_history(rows, path=HISTORY_FILE):
+    history = []
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+    history.append({'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'host': socket.gethostname(), 'results': rows})
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=2)
+
+def compare(path=HISTORY_FILE):
+    # Wall time of every stage across the recorded runs, one column per commit
+    with open(path) as f:
+        history = json.load(f)
+    table = pd.DataFrame([dict(row, commit=run['commit']) for run in history for row in run['results']])
+    return table.pivot_table(index=['size', 'stage'], columns='commit', values='wall_s', aggfunc='last')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing pipeline on synthetic XDF files')
+    parser.add_argument('--sizes', nargs='+', default=['10m'], choices=list(SIZES))
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--workdir', default=None, help='Where synthetic files are written (default: a temp dir)')
+    parser.add_argument('--compare', action='store_true', help='Print the history table and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare().to_string())
+        sys.exit()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='fox-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    rows = []
+    try:
+        for size in args.sizes:
+            rows += run_size(size, SIZES[size], workdir, args.channels)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    append_history(rows)
+    print(f"Results appended to {HISTORY_FILE}")
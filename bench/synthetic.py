@@ -0,0 +1,129 @@
+import time, struct
+import numpy as np
+
+SFREQ = 250.0  # OpenBCI Cyton sample rate
+CHANNELS = ['Fp1', 'Fp2', 'C3', 'C4', 'P7', 'P8', 'O1', 'O2',
+            'F7', 'F8', 'F3', 'F4', 'T7', 'T8', 'P3', 'P4']  # Cyton+Daisy order
+MARKERS = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10']  # Show part 1, 4 ads, show part 2, 4 ads
+VIDEO_DURATIONS = {'1': 275, '2': 30, '3': 30, '4': 75, '5': 15,
+                   '6': 190, '7': 30, '8': 30, '9': 30, '10': 15}  # Seconds, LEGO session
+CHUNK_SECONDS = 1.0  # LabRecorder writes roughly one chunk per second per stream
+CLOCK_OFFSET_SECONDS = 5.0
+START_TIME = 1000.0  # LSL clock at the start of the recording
+LSL_CHUNK_SECONDS = 0.04  # The OpenBCI GUI pushes small chunks; keeps the live test close to the real latency
+
+def _varlen(n):
+    if n < 256:
+        return b'\x01' + struct.pack('<B', n)
+    elif n < 2 ** 32:
+        return b'\x04' + struct.pack('<I', n)
+    return b'\x08' + struct.pack('<Q', n)
+
+def _chunk(tag, content):
+    return _varlen(len(content) + 2) + struct.pack('<H', tag) + content
+
+def _header(stream_id, name, stream_type, labels, srate, channel_format, source_id):
+    channels = ''.join(f'<channel><label>{label}</label><unit>microvolts</unit><type>{stream_type}</type></channel>'
+                       for label in labels)
+    xml = (f'<?xml version="1.0"?><info><name>{name}</name><type>{stream_type}</type>'
+           f'<channel_count>{len(labels)}</channel_count><nominal_srate>{srate}</nominal_srate>'
+           f'<channel_format>{channel_format}</channel_format><source_id>{source_id}</source_id>'
+           f'<created_at>{START_TIME}</created_at><desc><channels>{channels}</channels></desc></info>')
+    return _chunk(2, struct.pack('<I', stream_id) + xml.encode())
+
+def _footer(stream_id, first, last, count):
+    xml = (f'<?xml version="1.0"?><info><first_timestamp>{first}</first_timestamp>'
+           f'<last_timestamp>{last}</last_timestamp><sample_count>{count}</sample_count></info>')
+    return _chunk(6, struct.pack('<I', stream_id) + xml.encode())
+
+def _numeric_samples(stream_id, stamps, values):
+    record = np.dtype([('flag', 'u1'), ('stamp', '<f8'), ('values', '<f4', (values.shape[1],))])
+    samples = np.empty(len(stamps), dtype=record)
+    samples['flag'] = 8
+    samples['stamp'] = stamps
+    samples['values'] = values
+    return _chunk(3, struct.pack('<I', stream_id) + _varlen(len(stamps)) + samples.tobytes())
+
+def _string_samples(stream_id, stamp, value):
+    encoded = value.encode()
+    sample = b'\x08' + struct.pack('<d', stamp) + _varlen(len(encoded)) + encoded
+    return _chunk(3, struct.pack('<I', stream_id) + _varlen(1) + sample)
+
+def _clock_offset(stream_id, time, value):
+    return _chunk(4, struct.pack('<Idd', stream_id, time, value))
+
+def marker_schedule(seconds):
+    # Markers spread evenly over the session, as (marker, onset seconds from the start)
+    onsets = np.linspace(5.0, seconds - 5.0, len(MARKERS) + 1)[:-1]
+    return list(zip(MARKERS, onsets))
+
+def eeg_block(rng, n_samples, n_channels, start_sample, sfreq=SFREQ):
+    # Alpha rhythm, slow drift and white noise in microvolts, with an occasional blink on the frontal pair
+    t = (start_sample + np.arange(n_samples)) / sfreq
+    data = rng.standard_normal((n_samples, n_channels)).astype(np.float32) * 10
+    data += (20 * np.sin(2 * np.pi * 10 * t))[:, None]
+    data += (50 * np.sin(2 * np.pi * 0.05 * t))[:, None]
+    if rng.random() < 0.3 and n_samples >= 50:
+        onset = rng.integers(0, n_samples - 50)
+        data[onset:onset + 50, :2] += 150 * np.hanning(50)[:, None]
+    return data
+
+def write_xdf(path, seconds, n_channels=16, sfreq=SFREQ, seed=0):
+    # Writes an OpenBCI-like EEG stream plus the PsychoPyMarkers stream the PsychoPy scripts publish.
+    # Returns the events table (onset, duration, event_id in EEG samples) matching the markers.
+    rng = np.random.default_rng(seed)
+    labels = CHANNELS[:n_channels] + [f'EXG{i}' for i in range(max(0, n_channels - len(CHANNELS)))]
+    n_total = int(seconds * sfreq)
+    block = int(CHUNK_SECONDS * sfreq)
+    markers = marker_schedule(seconds)
+
+    with open(path, 'wb') as f:
+        f.write(b'XDF:')
+        f.write(_chunk(1, b'<?xml version="1.0"?><info><version>1.0</version></info>'))
+        f.write(_header(1, 'obci_eeg1', 'EEG', labels, sfreq, 'float32', 'openbcieeg'))
+        f.write(_header(2, 'PsychoPyMarkers', 'Markers', ['marker'], 0, 'string', 'uniqueid12345'))
+        next_marker, next_offset = 0, 0.0
+        for start in range(0, n_total, block):
+            n = min(block, n_total - start)
+            stamps = START_TIME + (start + np.arange(n)) / sfreq
+            f.write(_numeric_samples(1, stamps, eeg_block(rng, n, n_channels, start, sfreq)))
+            while next_marker < len(markers) and START_TIME + markers[next_marker][1] <= stamps[-1]:
+                f.write(_string_samples(2, START_TIME + markers[next_marker][1], markers[next_marker][0]))
+                next_marker += 1
+            if stamps[-1] - START_TIME >= next_offset:
+                f.write(_clock_offset(1, stamps[-1], 0.0))
+                f.write(_clock_offset(2, stamps[-1], 0.0))
+                next_offset += CLOCK_OFFSET_SECONDS
+        f.write(_footer(1, START_TIME, START_TIME + (n_total - 1) / sfreq, n_total))
+        f.write(_footer(2, START_TIME + markers[0][1], START_TIME + markers[-1][1], len(markers)))
+
+    events = [(int(round(onset * sfreq)), int(VIDEO_DURATIONS[marker] * sfreq), int(marker))
+              for marker, onset in markers]
+    # Keep every window inside the recording for short sessions
+    return np.array([(onset, min(duration, n_total - onset - 1), event_id) for onset, duration, event_id in events])
+
+def stream_lsl(seconds, n_channels=16, sfreq=SFREQ, seed=0, stop=None):
+    # Local real-time stand-in for the OpenBCI and PsychoPy outlets: same signal and marker schedule as
+    # write_xdf, pushed on the LSL clock. stop is an optional threading.Event to end early.
+    from pylsl import StreamInfo, StreamOutlet, local_clock
+    rng = np.random.default_rng(seed)
+    eeg_info = StreamInfo('obci_eeg1', 'EEG', n_channels, sfreq, 'float32', 'openbcieeg')
+    labels = eeg_info.desc().append_child('channels')
+    for label in (CHANNELS + [f'EXG{i}' for i in range(max(0, n_channels - len(CHANNELS)))])[:n_channels]:
+        labels.append_child('channel').append_child_value('label', label)
+    eeg_outlet = StreamOutlet(eeg_info)
+    marker_outlet = StreamOutlet(StreamInfo('PsychoPyMarkers', 'Markers', 1, 0, 'string', 'uniqueid12345'))
+    n_total = int(seconds * sfreq)
+    block = max(1, int(LSL_CHUNK_SECONDS * sfreq))
+    markers = marker_schedule(seconds)
+    start, sent, next_marker = local_clock(), 0, 0
+    while sent < n_total and not (stop is not None and stop.is_set()):
+        due = min(n_total, int((local_clock() - start) * sfreq))
+        if due - sent >= block or (due == n_total and due > sent):
+            data = eeg_block(rng, due - sent, n_channels, sent, sfreq)
+            eeg_outlet.push_chunk(data.tolist(), start + (due - 1) / sfreq)
+            sent = due
+        while next_marker < len(markers) and local_clock() - start >= markers[next_marker][1]:
+            marker_outlet.push_sample([markers[next_marker][0]], start + markers[next_marker][1])
+            next_marker += 1
+        time.sleep(LSL_CHUNK_SECONDS / 4)
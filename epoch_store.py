@@ -0,0 +1,136 @@
+import os, glob, json
+import numpy as np
+import pandas as pd
+
+# Per-condition store under derivatives/epochs/<condition>/:
+#   shards/<recording>.npy + .csv   written by each preprocessing job
+#   data.npy                        float32 (n_channels, total_samples), every epoch back to back
+#   index.csv                       one row per epoch with its offset and length into data.npy
+#   info.json                       channel names, sfreq and tmin shared by all epochs
+DATA_FILE = 'data.npy'
+INDEX_FILE = 'index.csv'
+INFO_FILE = 'info.json'
+INDEX_COLUMNS = ['subject', 'event', 'marker', 'onset', 'duration', 'exclude', 'offset', 'n_times']
+INDEX_DTYPES = {'subject': str, 'exclude': str}  # Keeps zero-padded subject ids like '001' as written
+
+def store_dir_for(deriv_root, condition):
+    return os.path.join(deriv_root, 'epochs', condition)
+
+def write_shard(store_dir, name, epochs, rows, ch_names, sfreq, tmin):
+    # epochs: list of (n_channels, n_times) arrays, rows: matching index dicts without offsets
+    shard_dir = os.path.join(store_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    lengths = [e.shape[1] for e in epochs]
+    index = pd.DataFrame(rows)
+    index['n_times'] = lengths
+    index['offset'] = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(int) if lengths else []
+
+    data = np.concatenate(epochs, axis=1).astype(np.float32) if epochs else np.empty((len(ch_names), 0), np.float32)
+    data_path = os.path.join(shard_dir, f'{name}.npy')
+    np.save(data_path, data)
+    index.to_csv(os.path.join(shard_dir, f'{name}.csv'), index=False)
+    with open(os.path.join(shard_dir, f'{name}.json'), 'w') as f:
+        json.dump({'ch_names': list(ch_names), 'sfreq': sfreq, 'tmin': tmin}, f)
+    return data_path
+
+def consolidate(store_dir):
+    # Concatenate every shard into one contiguous float32 array, streaming shard by shard
+    shard_dir = os.path.join(store_dir, 'shards')
+    names = sorted(os.path.splitext(os.path.basename(p))[0] for p in glob.glob(os.path.join(shard_dir, '*.csv')))
+    if not names:
+        raise FileNotFoundError(f'No epoch shards in {shard_dir}')
+
+    infos = []
+    for name in names:
+        with open(os.path.join(shard_dir, f'{name}.json')) as f:
+            infos.append(json.load(f))
+    if any(info != infos[0] for info in infos):
+        raise ValueError(f'Shards in {shard_dir} have different channels, sampling rates or tmin')
+
+    indexes = [pd.read_csv(os.path.join(shard_dir, f'{name}.csv'), dtype=INDEX_DTYPES) for name in names]
+    totals = [int(index['n_times'].sum()) for index in indexes]
+    starts = np.concatenate([[0], np.cumsum(totals)[:-1]])
+    data = np.lib.format.open_memmap(os.path.join(store_dir, DATA_FILE + '.tmp'), mode='w+', dtype=np.float32,
+                                     shape=(len(infos[0]['ch_names']), int(sum(totals))))
+    for name, index, start, total in zip(names, indexes, starts, totals):
+        data[:, start:start + total] = np.load(os.path.join(shard_dir, f'{name}.npy'), mmap_mode='r')
+        index['offset'] += start
+    data.flush()
+    del data
+    os.replace(os.path.join(store_dir, DATA_FILE + '.tmp'), os.path.join(store_dir, DATA_FILE))
+
+    pd.concat(indexes, ignore_index=True)[INDEX_COLUMNS].to_csv(os.path.join(store_dir, INDEX_FILE), index=False)
+    with open(os.path.join(store_dir, INFO_FILE), 'w') as f:
+        json.dump(infos[0], f)
+    return os.path.join(store_dir, DATA_FILE)
+
+class EpochStore:
+    # Lazy reader over a consolidated store: epochs come back as views into the memory-mapped data.npy,
+    # so nothing is read from disk until the returned array is used
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = pd.read_csv(os.path.join(store_dir, INDEX_FILE), dtype=INDEX_DTYPES)
+        with open(os.path.join(store_dir, INFO_FILE)) as f:
+            info = json.load(f)
+        self.ch_names, self.sfreq, self.tmin = info['ch_names'], info['sfreq'], info['tmin']
+        self.data = np.load(os.path.join(store_dir, DATA_FILE), mmap_mode='r')
+
+    @classmethod
+    def from_derivatives(cls, deriv_root, condition):
+        return cls(store_dir_for(deriv_root, condition))
+
+    def __len__(self):
+        return len(self.index)
+
+    def select(self, subject=None, event=None, marker=None):
+        mask = np.ones(len(self.index), dtype=bool)
+        for column, value in (('subject', subject), ('event', event), ('marker', marker)):
+            if value is not None:
+                values = [value] if np.isscalar(value) else list(value)
+                mask &= self.index[column].isin(values).to_numpy()
+        return self.index[mask]
+
+    def _picks(self, channels):
+        if channels is None:
+            return slice(None)
+        channels = [channels] if np.isscalar(channels) else channels
+        picks = [self.ch_names.index(c) if isinstance(c, str) else int(c) for c in channels]
+        # Contiguous picks stay a slice so the result is still a view
+        if picks == list(range(picks[0], picks[-1] + 1)):
+            return slice(picks[0], picks[-1] + 1)
+        return picks
+
+    def _window(self, n_times, tmin, tmax):
+        start = 0 if tmin is None else max(0, int(round((tmin - self.tmin) * self.sfreq)))
+        stop = n_times if tmax is None else min(n_times, int(round((tmax - self.tmin) * self.sfreq)) + 1)
+        return start, stop
+
+    def get(self, row, channels=None, tmin=None, tmax=None):
+        # row: an index label or a row of self.index; returns (n_channels, n_times) for that epoch
+        if not isinstance(row, pd.Series):
+            row = self.index.loc[row]
+        start, stop = self._window(int(row['n_times']), tmin, tmax)
+        offset = int(row['offset'])
+        return self.data[self._picks(channels), offset + start:offset + stop]
+
+    def times(self, row, tmin=None, tmax=None):
+        if not isinstance(row, pd.Series):
+            row = self.index.loc[row]
+        start, stop = self._window(int(row['n_times']), tmin, tmax)
+        return self.tmin + np.arange(start, stop) / self.sfreq
+
+    def iter_epochs(self, subject=None, event=None, marker=None, channels=None, tmin=None, tmax=None):
+        for _, row in self.select(subject, event, marker).iterrows():
+            yield row, self.get(row, channels, tmin, tmax)
+
+    def grand_average(self, subject=None, event=None, marker=None, channels=None, tmin=None, tmax=None):
+        # Streaming mean over the selected epochs, truncated to the shortest one so lengths line up
+        rows = self.select(subject, event, marker)
+        if rows.empty:
+            raise ValueError('No epochs match the selection')
+        n_times = min(self._window(int(n), tmin, tmax)[1] - self._window(int(n), tmin, tmax)[0] for n in rows['n_times'])
+        total = None
+        for _, row in rows.iterrows():
+            epoch = self.get(row, channels, tmin, tmax)[:, :n_times]
+            total = epoch.astype(np.float64) if total is None else total + epoch
+        return total / len(rows)
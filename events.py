@@ -0,0 +1,155 @@
+import os, re, argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from xdfio import load_stream
+from videos import condition_durations
+
+# durations for each video in seconds (LEGO + 8 ads)
+LEGO_VIDEO_DURATIONS = {
+    '1': 275, '2': 30, '3': 30, '4': 75, '5': 15,
+    '6': 190, '7': 30, '8': 30, '9': 30, '10': 15
+}
+GAP_FACTOR = 1.5  # Inter-sample intervals above this many nominal periods count as dropped samples
+
+def align_to_samples(eeg_stamps, stamps):
+    # Index of the EEG sample whose time stamp is closest to each stamp, and the residual in seconds
+    stamps = np.asarray(stamps, dtype=np.float64)
+    right = np.clip(np.searchsorted(eeg_stamps, stamps), 1, len(eeg_stamps) - 1)
+    left = right - 1
+    samples = np.where(stamps - eeg_stamps[left] <= eeg_stamps[right] - stamps, left, right)
+    return samples, stamps - eeg_stamps[samples]
+
+def timing_stats(eeg_stamps, nominal_srate, marker_stamps, samples):
+    intervals = np.diff(eeg_stamps)
+    gaps = intervals > GAP_FACTOR / nominal_srate  # Drop-outs, kept out of the jitter and rate estimates
+    # Line fit of the stamps against sample indices that count the samples lost in each gap, so a drop-out
+    # is not mistaken for clock drift
+    steps = np.where(gaps, np.maximum(np.round(intervals * nominal_srate), 1), 1)
+    effective_srate = 1 / np.polyfit(np.r_[0, np.cumsum(steps)], eeg_stamps, 1)[0]
+    # Where the old nominal-rate conversion would have put each marker, relative to the time-stamp alignment
+    nominal_samples = ((marker_stamps - eeg_stamps[0]) * nominal_srate).astype(np.int64)
+    return {'n_samples': len(eeg_stamps), 'n_markers': len(marker_stamps),
+            'nominal_srate': nominal_srate, 'effective_srate': effective_srate,
+            'drift_ppm': (effective_srate / nominal_srate - 1) * 1e6,
+            'jitter_std_ms': float(np.std(intervals[~gaps] - 1 / effective_srate) * 1e3) if (~gaps).any() else 0.0,
+            'dropped_gaps': int(np.sum(gaps)),
+            'dropped_samples': int(np.sum(np.maximum(np.round(intervals * nominal_srate) - 1, 0))),
+            'max_nominal_error_samples': int(np.max(np.abs(nominal_samples - samples), initial=0))}
+
+def extract_events(file_path, durations=LEGO_VIDEO_DURATIONS):
+    # Markers -> onset,duration,event_id in EEG samples, aligned on the EEG stream's own time stamps.
+    # The stamps are not dejittered: the line fit would hide jitter and smear drop-outs shorter than its
+    # segment break, which both the statistics and the sample alignment need to see.
+    eeg_stream = load_stream(file_path, 'EEG', channels=[], dejitter=False)  # Time stamps only, no channel data
+    eeg_stamps = eeg_stream['time_stamps']
+    if len(eeg_stamps) < 2:
+        raise ValueError(f'EEG stream has {len(eeg_stamps)} samples in file: {file_path}')
+    nominal_srate = float(eeg_stream['info']['nominal_srate'][0])
+    try:
+        marker_stream = load_stream(file_path, 'Markers')
+    except ValueError:
+        marker_stream = {'time_series': [], 'time_stamps': np.empty(0)}
+
+    markers = np.array([m[0] if m else '' for m in marker_stream['time_series']], dtype=object)
+    keep = np.array([m[:1].isdigit() and m in durations for m in markers], dtype=bool)
+    markers, marker_stamps = markers[keep], np.asarray(marker_stream['time_stamps'])[keep]
+
+    # Videos that start before the first EEG sample or end after the last one would be clipped to the
+    # recording and look complete downstream, so they are left out and counted
+    end_stamps = marker_stamps + np.array([durations[m] for m in markers], dtype=float)
+    inside = (marker_stamps >= eeg_stamps[0]) & (end_stamps <= eeg_stamps[-1] + 1 / nominal_srate)
+    if not inside.all():
+        print(f"{os.path.basename(file_path)}: {int((~inside).sum())} events run outside the EEG recording, "
+              f"left out: {list(markers[~inside])}")
+    markers, marker_stamps, end_stamps = markers[inside], marker_stamps[inside], end_stamps[inside]
+
+    onsets, onset_error = align_to_samples(eeg_stamps, marker_stamps)
+    offsets, _ = align_to_samples(eeg_stamps, end_stamps)
+    events_df = pd.DataFrame({'onset': onsets, 'duration': offsets - onsets,
+                              'event_id': markers.astype(int) if len(markers) else np.empty(0, dtype=int)})
+
+    stats = timing_stats(eeg_stamps, nominal_srate, marker_stamps, onsets)
+    stats['outside_events'] = int((~inside).sum())
+    stats['max_alignment_error_ms'] = float(np.max(np.abs(onset_error), initial=0) * 1e3)
+    return events_df, stats
+
+def extract_events_batch(file_paths, durations=LEGO_VIDEO_DURATIONS):
+    # One call for a whole cohort: events per file plus one row of timing statistics per file
+    events, rows = {}, []
+    for file_path in file_paths:
+        events[file_path], stats = extract_events(file_path, durations)
+        rows.append(dict(stats, file=os.path.basename(file_path)))
+    return events, pd.DataFrame(rows)
+
+def write_events(events_df, csv_path):
+    events_df.to_csv(csv_path, index=False)
+    print(f'Event file saved to {csv_path}')
+
+def find_recordings(bids_root, condition=''):
+    # (subject_id, subject_dir, xdf path) for every sub-* folder; one events CSV per subject folder
+    recordings = []
+    for subject_folder in sorted(os.listdir(bids_root)):
+        subject_match = re.match(r'sub-(\d{3})', subject_folder)
+        subject_dir = os.path.join(bids_root, subject_folder)
+        if not subject_match or condition not in subject_folder or not os.path.isdir(subject_dir):
+            continue
+        xdf_files = sorted(f for f in os.listdir(subject_dir) if f.endswith('.xdf'))
+        if len(xdf_files) > 1:
+            print(f"{subject_folder} has {len(xdf_files)} XDF files, using {xdf_files[0]}")
+        if xdf_files:
+            recordings.append((subject_match.group(1), subject_dir, os.path.join(subject_dir, xdf_files[0])))
+    return recordings
+
+def events_path(subject_id, subject_dir):
+    return os.path.join(subject_dir, f'sub-{subject_id}_task-events.csv')
+
+def is_current(csv_path, file_path):
+    return os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(file_path)
+
+def run_recording(recording, durations):
+    subject_id, subject_dir, file_path = recording
+    events_df, stats = extract_events(file_path, durations)
+    write_events(events_df, events_path(subject_id, subject_dir))
+    return dict(stats, subject=subject_id, file=os.path.basename(file_path), n_events=len(events_df))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write sub-XXX_task-events.csv for every XDF recording')
+    parser.add_argument('--bids-root', default='../')
+    parser.add_argument('--condition', default='', help='Only subject folders containing this string')
+    parser.add_argument('--lists-dir', default=None, help='PsychoPy folder with lists*.xlsx and videos/')
+    parser.add_argument('--show', default=None, help='Show played in this condition, e.g. LEGO or BigMood')
+    parser.add_argument('--fallback-lego', action='store_true',
+                        help='Use the LEGO durations if no video of the playlist is found under --lists-dir')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--force', action='store_true', help='Rewrite events files newer than their XDF')
+    args = parser.parse_args()
+
+    # The LEGO table is only used when no lists folder is given, or on request: any other show would get
+    # wrong durations in every events file
+    durations = LEGO_VIDEO_DURATIONS
+    if args.lists_dir:
+        try:
+            durations = condition_durations(args.lists_dir, args.show)
+        except FileNotFoundError as e:
+            if not args.fallback_lego:
+                parser.error(f"{e} (pass --fallback-lego to use the LEGO durations anyway)")
+            print(f"{e}; using the LEGO durations")
+    recordings = find_recordings(args.bids_root, args.condition)
+    todo = [r for r in recordings if args.force or not is_current(events_path(r[0], r[1]), r[2])]
+    print(f"{len(recordings) - len(todo)} of {len(recordings)} events files are current")
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(run_recording, recording, durations): recording for recording in todo}
+        for future in as_completed(futures):
+            subject_id, _, file_path = futures[future]
+            try:
+                rows.append(future.result())
+            except Exception as e:  # One bad recording must not stop the batch or lose the summary
+                print(f"sub-{subject_id} {os.path.basename(file_path)}: {e!r}")
+                rows.append({'subject': subject_id, 'file': os.path.basename(file_path), 'error': repr(e)})
+            print(f"[{len(rows)}/{len(todo)}] sub-{subject_id} done")
+
+    if rows:
+        print(pd.DataFrame(rows).sort_values('subject').to_string(index=False))
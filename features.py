@@ -0,0 +1,158 @@
+import os, json, hashlib, argparse
+import numpy as np
+import pandas as pd
+from scipy.signal import welch
+from numpy.lib.stride_tricks import sliding_window_view
+from epoch_store import EpochStore, store_dir_for, DATA_FILE, INDEX_FILE, INFO_FILE
+from videos import condition_frame_rates
+
+BANDS = {'theta': (4.0, 8.0), 'alpha': (8.0, 13.0), 'beta': (13.0, 30.0)}
+WELCH_SECONDS = 2.0  # Segment length; 50% overlap, Hann window
+FEATURE_TMIN = 0.0  # Only the video itself, not the pre-stimulus baseline
+FEATURE_CHUNK = 2**27  # Bytes of float64 epoch data handed to one welch call
+ENGAGEMENT_WINDOW = 2.0  # Seconds per sliding window
+ENGAGEMENT_STEP = 0.25
+ASYMMETRY_PAIRS = [('F4', 'F3'), ('Fp2', 'Fp1')]  # (right, left); the first pair present in the montage is used
+VIDEO_FPS = 30.0  # Frame rate when the videos themselves are not available
+
+def features_dir_for(deriv_root, condition):
+    return os.path.join(deriv_root, 'features', condition)
+
+def store_hash(store_dir, *params):
+    # Index and info contents plus the size and mtime of data.npy: changes whenever the store is consolidated
+    digest = hashlib.sha256()
+    for name in (INDEX_FILE, INFO_FILE):
+        with open(os.path.join(store_dir, name), 'rb') as f:
+            digest.update(f.read())
+    stat = os.stat(os.path.join(store_dir, DATA_FILE))
+    digest.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+def band_power(data, sfreq, bands=BANDS, seconds=WELCH_SECONDS):
+    # data (..., n_times) -> (..., n_bands), integrated Welch PSD over each band
+    nperseg = min(data.shape[-1], int(round(seconds * sfreq)))
+    freqs, psd = welch(data, fs=sfreq, nperseg=nperseg, noverlap=nperseg // 2, axis=-1)
+    df = freqs[1] - freqs[0]
+    return np.stack([psd[..., (freqs >= lo) & (freqs < hi)].sum(axis=-1) * df for lo, hi in bands.values()], axis=-1)
+
+def epoch_batches(store, rows, tmin=FEATURE_TMIN, chunk=FEATURE_CHUNK):
+    # Epochs of equal length are stacked into (n_epochs, n_channels, n_times) batches of at most chunk bytes
+    windows = rows['n_times'].map(lambda n: store._window(int(n), tmin, None))
+    lengths = windows.map(lambda w: w[1] - w[0])
+    for n_times, group in rows.groupby(lengths.to_numpy()):
+        if n_times <= 0:
+            continue
+        per_epoch = max(1, chunk // (len(store.ch_names) * n_times * 8))
+        for start in range(0, len(group), per_epoch):
+            batch = group.iloc[start:start + per_epoch]
+            yield batch, np.stack([store.get(row, tmin=tmin) for _, row in batch.iterrows()]).astype(np.float64)
+
+def compute_band_power(store, rows=None, bands=BANDS, tmin=FEATURE_TMIN, chunk=FEATURE_CHUNK):
+    # Tidy table: one row per subject x event x channel x band
+    rows = store.index if rows is None else rows
+    tables = []
+    for batch, data in epoch_batches(store, rows, tmin, chunk):
+        power = band_power(data, store.sfreq, bands)  # (n_epochs, n_channels, n_bands)
+        n_epochs, n_channels, n_bands = power.shape
+        tables.append(pd.DataFrame({
+            'subject': np.repeat(batch['subject'].to_numpy(), n_channels * n_bands),
+            'event': np.repeat(batch['event'].to_numpy(), n_channels * n_bands),
+            'marker': np.repeat(batch['marker'].to_numpy(), n_channels * n_bands),
+            'channel': np.tile(np.repeat(store.ch_names, n_bands), n_epochs),
+            'band': np.tile(list(bands), n_epochs * n_channels),
+            'power': power.ravel()}))
+    columns = ['subject', 'event', 'marker', 'channel', 'band', 'power']
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(tables, ignore_index=True).sort_values(['subject', 'event', 'channel']).reset_index(drop=True)
+
+def band_power_table(deriv_root, condition, bands=BANDS, tmin=FEATURE_TMIN, force=False):
+    # Cached per condition under derivatives/features/<condition>/, keyed by the epoch store and parameters
+    store_dir = store_dir_for(deriv_root, condition)
+    key = store_hash(store_dir, bands, tmin, WELCH_SECONDS)
+    out_path = os.path.join(features_dir_for(deriv_root, condition), f'band_power-{key}.csv')
+    if os.path.exists(out_path) and not force:
+        return pd.read_csv(out_path, dtype={'subject': str})
+    table = compute_band_power(EpochStore(store_dir), bands=bands, tmin=tmin)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    table.to_csv(out_path + '.tmp', index=False)
+    os.replace(out_path + '.tmp', out_path)
+    print(f"Band power saved to {out_path}")
+    return table
+
+def features_hash_dir(deriv_root, condition, name, *params):
+    store_dir = store_dir_for(deriv_root, condition)
+    return os.path.join(features_dir_for(deriv_root, condition), f'{name}-{store_hash(store_dir, *params)}')
+
+def windowed_band_power(epoch, sfreq, window, step, bands=BANDS, chunk=FEATURE_CHUNK):
+    # epoch (n_channels, n_times) -> (n_channels, n_windows, n_bands). The windows are a strided view of the
+    # epoch; only chunk bytes of them are copied at a time for the Hann-tapered FFT.
+    windows = sliding_window_view(epoch, window, axis=-1)[:, ::step]
+    freqs = np.fft.rfftfreq(window, 1 / sfreq)
+    masks = [(freqs >= lo) & (freqs < hi) for lo, hi in bands.values()]
+    taper = np.hanning(window)
+    out = np.empty(windows.shape[:2] + (len(bands),))
+    per_chunk = max(1, chunk // (windows.shape[0] * window * 16))
+    for start in range(0, windows.shape[1], per_chunk):
+        block = windows[:, start:start + per_chunk].astype(np.float64)
+        block = (block - block.mean(axis=-1, keepdims=True)) * taper
+        psd = np.abs(np.fft.rfft(block, axis=-1)) ** 2
+        out[:, start:start + per_chunk] = np.stack([psd[..., m].sum(axis=-1) for m in masks], axis=-1)
+    return out
+
+def engagement_series(epoch, sfreq, ch_names, fps, window=ENGAGEMENT_WINDOW, step=ENGAGEMENT_STEP):
+    # Frontal alpha asymmetry ln(alpha right) - ln(alpha left) and beta / (alpha + theta) averaged over channels,
+    # interpolated from window centres to the video frame times
+    window_samples, step_samples = int(round(window * sfreq)), max(1, int(round(step * sfreq)))
+    if epoch.shape[1] < window_samples:
+        return pd.DataFrame(columns=['frame', 'time', 'faa', 'engagement'])
+    power = windowed_band_power(epoch, sfreq, window_samples, step_samples)
+    theta, alpha, beta = (power[..., list(BANDS).index(band)] for band in ('theta', 'alpha', 'beta'))
+    centres = (np.arange(power.shape[1]) * step_samples + window_samples / 2) / sfreq
+    frames = np.arange(int(epoch.shape[1] / sfreq * fps))
+    times = frames / fps
+    lookup = {ch.lower(): i for i, ch in enumerate(ch_names)}
+    pair = next(((lookup[r.lower()], lookup[l.lower()]) for r, l in ASYMMETRY_PAIRS
+                 if r.lower() in lookup and l.lower() in lookup), None)
+    tiny = np.finfo(float).tiny
+    faa = np.log(alpha[pair[0]] + tiny) - np.log(alpha[pair[1]] + tiny) if pair else np.full(len(centres), np.nan)
+    engagement = (beta / np.maximum(alpha + theta, tiny)).mean(axis=0)
+    return pd.DataFrame({'frame': frames, 'time': times, 'faa': np.interp(times, centres, faa),
+                         'engagement': np.interp(times, centres, engagement)})
+
+def engagement_tables(deriv_root, condition, frame_rates=None, window=ENGAGEMENT_WINDOW, step=ENGAGEMENT_STEP,
+                      force=False):
+    # One CSV per subject and event: sub-XXX_event-N_marker-M_engagement.csv, in a directory keyed by the store hash
+    frame_rates = frame_rates or {}
+    out_dir = features_hash_dir(deriv_root, condition, 'engagement', frame_rates, window, step, ASYMMETRY_PAIRS)
+    store = EpochStore.from_derivatives(deriv_root, condition)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for _, row in store.index.dropna(subset=['marker']).iterrows():
+        marker = str(int(row['marker']))
+        path = os.path.join(out_dir, f"sub-{row['subject']}_event-{int(row['event'])}_marker-{marker}_engagement.csv")
+        if force or not os.path.exists(path):
+            epoch = np.asarray(store.get(row, tmin=FEATURE_TMIN))
+            series = engagement_series(epoch, store.sfreq, store.ch_names, frame_rates.get(marker, VIDEO_FPS), window, step)
+            series.to_csv(path, index=False)
+        paths.append(path)
+    print(f"{len(paths)} engagement series in {out_dir}")
+    return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Theta, alpha and beta band power for every stored epoch')
+    parser.add_argument('--bids-root', default='../')
+    parser.add_argument('--condition', default='bigmood')
+    parser.add_argument('--force', action='store_true', help='Recompute even if a cached table exists')
+    parser.add_argument('--engagement', action='store_true', help='Also write sliding-window FAA and engagement series')
+    parser.add_argument('--lists-dir', default=None, help='PsychoPy folder with lists*.xlsx and videos/, for frame rates')
+    parser.add_argument('--show', default=None, help='Show played in this condition, e.g. LEGO or BigMood')
+    args = parser.parse_args()
+
+    deriv_root = os.path.join(args.bids_root, 'derivatives')
+    table = band_power_table(deriv_root, args.condition, force=args.force)
+    print(table.groupby(['band', 'channel'])['power'].mean().unstack().to_string())
+    if args.engagement:
+        frame_rates = condition_frame_rates(args.lists_dir, args.show) if args.lists_dir else None
+        engagement_tables(deriv_root, args.condition, frame_rates, force=args.force)
@@ -0,0 +1,89 @@
+import functools
+from fractions import Fraction
+import numpy as np
+from mne.filter import create_filter
+from scipy.signal import oaconvolve, butter, sosfilt, sosfilt_zi, resample_poly
+
+FILTER_CHUNK = 2 ** 18  # Samples per block (~17 min at 250 Hz)
+IIR_ORDER = 4  # Butterworth order of each pass, as in raw.filter(method='iir')
+
+@functools.lru_cache(maxsize=None)
+def fir_kernel(sfreq, l_freq, h_freq):
+    # Same zero-phase firwin design raw.filter uses by default, built once per (sfreq, band)
+    return create_filter(None, sfreq, l_freq, h_freq, method='fir', fir_design='firwin', phase='zero', verbose=False)
+
+@functools.lru_cache(maxsize=None)
+def iir_sos(sfreq, l_freq, h_freq, order=IIR_ORDER):
+    return butter(order, [l_freq, h_freq], btype='bandpass', fs=sfreq, output='sos')
+
+def fir_filter(data, sfreq, l_freq, h_freq, out=None, chunk=FILTER_CHUNK):
+    # Overlap-add convolution over (n_channels, n_times) blocks; all channels go through one FFT batch.
+    # The kernel is symmetric with odd length, so 'valid' output over a block padded by half the kernel
+    # on each side is exactly the zero-phase result. out may be data itself (in place) or a memmap.
+    kernel = fir_kernel(sfreq, l_freq, h_freq)
+    half = len(kernel) // 2
+    n_times = data.shape[-1]
+    if out is None:
+        out = np.empty(data.shape, dtype=np.result_type(data.dtype, np.float32))
+    if n_times <= len(kernel):
+        # Reflection is limited to the signal length and zero-padded beyond it, as in MNE
+        reflect = min(half, n_times - 1)
+        padded = np.pad(np.asarray(data), ((0, 0), (reflect, reflect)), mode='reflect', reflect_type='odd')
+        padded = np.pad(padded, ((0, 0), (half - reflect, half - reflect)))
+        out[:] = oaconvolve(padded, kernel[None, :], mode='valid', axes=-1)
+        return out
+
+    kernel = kernel.astype(out.dtype)[None, :]
+    chunk = max(chunk, half)
+    # Odd reflection about the edge samples (2 * x[0] - x[half:0:-1]), as MNE's reflect_limited padding;
+    # both edges are read before anything is overwritten
+    context = 2 * np.array(data[:, :1]) - np.array(data[:, 1:half + 1][:, ::-1])
+    tail = 2 * np.array(data[:, -1:]) - np.array(data[:, n_times - half - 1:n_times - 1][:, ::-1])
+    for start in range(0, n_times, chunk):
+        stop = min(start + chunk, n_times)
+        block = np.array(data[:, start:min(stop + half, n_times)])
+        right = tail[:, :max(0, stop + half - n_times)]
+        segment = np.concatenate([context, block, right], axis=1)
+        context = block[:, stop - start - half:stop - start]
+        out[:, start:stop] = oaconvolve(segment, kernel, mode='valid', axes=-1)
+    return out
+
+def iir_filter(data, sfreq, l_freq, h_freq, out=None, chunk=FILTER_CHUNK):
+    # Zero-phase forward-backward SOS filtering in blocks, carrying the filter state between blocks
+    sos = iir_sos(sfreq, l_freq, h_freq)
+    zi = sosfilt_zi(sos)[:, None, :]
+    n_times = data.shape[-1]
+    if out is None:
+        out = np.empty(data.shape, dtype=np.result_type(data.dtype, np.float32))
+    blocks = [(start, min(start + chunk, n_times)) for start in range(0, n_times, chunk)]
+
+    state = zi * np.asarray(data[:, 0])[None, :, None]
+    for start, stop in blocks:
+        out[:, start:stop], state = sosfilt(sos, data[:, start:stop], axis=-1, zi=state)
+    state = zi * np.asarray(out[:, -1])[None, :, None]
+    for start, stop in reversed(blocks):
+        filtered, state = sosfilt(sos, out[:, start:stop][:, ::-1], axis=-1, zi=state)
+        out[:, start:stop] = filtered[:, ::-1]
+    return out
+
+def filter_data(data, sfreq, l_freq, h_freq, method='fir', out=None, chunk=FILTER_CHUNK):
+    if method == 'fir':
+        return fir_filter(data, sfreq, l_freq, h_freq, out, chunk)
+    elif method == 'iir':
+        return iir_filter(data, sfreq, l_freq, h_freq, out, chunk)
+    raise ValueError(f'Unknown filter method: {method}')
+
+def resample_data(data, sfreq, new_sfreq):
+    # Polyphase resampling along the last axis; resample_poly applies its own anti-aliasing FIR
+    ratio = Fraction(new_sfreq / sfreq).limit_denominator(1000)
+    if ratio == 1:
+        return data
+    return resample_poly(data, ratio.numerator, ratio.denominator, axis=-1)
+
+def filter_memmap(time_series, out_path, sfreq, l_freq, h_freq, method='fir', chunk=FILTER_CHUNK):
+    # Filter a cached (n_times, n_channels) stream from xdfio straight into a float32 .npy on disk,
+    # so only one block per channel is ever held in memory
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=time_series.shape)
+    filter_data(time_series.T, sfreq, l_freq, h_freq, method, out=out.T, chunk=chunk)
+    out.flush()
+    return out
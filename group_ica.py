@@ -0,0 +1,106 @@
+import os, json
+import numpy as np
+
+GROUP_COMPONENTS = None  # None keeps one component per channel; an int PCA-reduces the whitened data first
+GROUP_BATCH = 2 ** 14  # Samples per random segment of a minibatch
+GROUP_BATCHES = 16  # Segments per FastICA iteration, drawn across recordings in proportion to their length
+GROUP_MAX_ITER = 500
+GROUP_TOL = 1e-3  # Minibatch updates are noisy, so the tolerance is looser than a full-data FastICA
+GROUP_CHUNK = 2 ** 18  # Samples per block in the covariance pass
+GROUP_MODEL_FILE = 'group-ica.npz'
+
+def group_dir_for(deriv_root, condition):
+    return os.path.join(deriv_root, 'group_ica', condition)
+
+def group_model_path(deriv_root, condition):
+    return os.path.join(group_dir_for(deriv_root, condition), GROUP_MODEL_FILE)
+
+def streaming_covariance(recordings, chunk=GROUP_CHUNK):
+    # recordings: (n_channels, n_times) arrays or memmaps. Block means and scatter matrices are merged with
+    # Chan's update, so only one block is in memory at a time.
+    count, mean, scatter = 0, None, None
+    for data in recordings:
+        for start in range(0, data.shape[1], chunk):
+            block = np.asarray(data[:, start:start + chunk], dtype=np.float64)
+            n = block.shape[1]
+            block_mean = block.mean(axis=1)
+            centred = block - block_mean[:, None]
+            if mean is None:
+                mean, scatter = np.zeros_like(block_mean), np.zeros((len(block), len(block)))
+            delta = block_mean - mean
+            mean = mean + delta * n / (count + n)
+            scatter += centred @ centred.T + np.outer(delta, delta) * count * n / (count + n)
+            count += n
+    return mean, scatter / (count - 1), count
+
+def whitening(cov, n_components=None):
+    # (n_components, n_channels) PCA whitening, strongest directions first
+    values, vectors = np.linalg.eigh(cov)
+    order = np.argsort(values)[::-1][:n_components]
+    return (vectors[:, order] / np.sqrt(values[order])).T
+
+def symmetric_decorrelation(w):
+    values, vectors = np.linalg.eigh(w @ w.T)
+    return vectors @ np.diag(1 / np.sqrt(values)) @ vectors.T @ w
+
+def minibatch(recordings, rng, batch=GROUP_BATCH, n_batches=GROUP_BATCHES):
+    lengths = np.array([r.shape[1] for r in recordings], dtype=np.float64)
+    blocks = []
+    for i in rng.choice(len(recordings), n_batches, p=lengths / lengths.sum()):
+        start = rng.integers(0, max(1, int(lengths[i]) - batch + 1))
+        blocks.append(np.asarray(recordings[i][:, start:start + batch], dtype=np.float64))
+    return np.concatenate(blocks, axis=1)
+
+def minibatch_fastica(recordings, mean, white, seed, max_iter=GROUP_MAX_ITER, tol=GROUP_TOL):
+    # Symmetric FastICA with the logcosh contrast (as in MNE's default fastica), each fixed-point step
+    # estimated on a fresh random minibatch of whitened samples instead of the whole cohort
+    rng = np.random.default_rng(seed)
+    w = symmetric_decorrelation(rng.standard_normal((len(white), len(white))))
+    change = np.inf
+    for iteration in range(1, max_iter + 1):
+        x = white @ (minibatch(recordings, rng) - mean[:, None])
+        g = np.tanh(w @ x)
+        w_new = symmetric_decorrelation(g @ x.T / x.shape[1] - (1 - g ** 2).mean(axis=1)[:, None] * w)
+        change = np.max(np.abs(np.abs(np.einsum('ij,ij->i', w_new, w)) - 1))
+        w = w_new
+        if change < tol:
+            break
+    return w, iteration, change
+
+def fit_group_model(recordings, ch_names, sfreq, seed, n_components=GROUP_COMPONENTS, **meta):
+    mean, cov, n_samples = streaming_covariance(recordings)
+    white = whitening(cov, n_components)
+    w, n_iter, change = minibatch_fastica(recordings, mean, white, seed)
+    unmixing = w @ white
+    print(f"Group ICA: {len(recordings)} recordings, {n_samples} samples, {n_iter} iterations (change {change:.1e})")
+    return {'mean': mean, 'unmixing': unmixing, 'mixing': np.linalg.pinv(unmixing), 'ch_names': list(ch_names),
+            'sfreq': sfreq, 'n_samples': n_samples, 'n_iter': n_iter, 'converged': bool(change < GROUP_TOL),
+            'meta': json.dumps(meta, sort_keys=True, default=str)}
+
+def save_group_model(path, model):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **model)
+    os.replace(path + '.tmp', path)
+    return path
+
+def load_group_model(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'No group ICA model, fit one with preprocess.py --fit-group-ica: {path}')
+    with np.load(path) as f:
+        model = {key: f[key] for key in f.files}
+    model['ch_names'] = [str(ch) for ch in model['ch_names']]
+    return model
+
+def group_source_transform(model):
+    # Same (matrix, offset) form as preprocess.source_transform, for reject_components
+    unmixing = model['unmixing']
+    return unmixing.astype(np.float32), (unmixing @ model['mean']).astype(np.float32)[:, None]
+
+def remove_components(model, data, exclude):
+    # Back-projects the excluded group components out of data (..., n_channels, n_times), in place
+    if not len(exclude):
+        return data
+    sources = model['unmixing'][exclude] @ (data - model['mean'][:, None])
+    data -= model['mixing'][:, exclude] @ sources
+    return data
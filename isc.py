@@ -0,0 +1,112 @@
+import os, argparse
+import numpy as np
+import pandas as pd
+from scipy.linalg import eigh
+from epoch_store import EpochStore
+
+ISC_COMPONENTS = 3
+ISC_SHRINKAGE = 0.1  # Shrinks the within-subject covariance towards its mean eigenvalue before the eigendecomposition
+ISC_TMIN = 0.0  # Video only, no pre-stimulus baseline
+ISC_WINDOW = 5.0  # Seconds, time-resolved ISC
+ISC_STEP = 1.0
+
+def isc_dir_for(deriv_root, condition):
+    return os.path.join(deriv_root, 'isc', condition)
+
+def marker_epochs(store, marker, tmin=ISC_TMIN):
+    # One epoch per subject for this ad, all cut to the shortest one so time points line up
+    rows = store.select(marker=marker).drop_duplicates('subject')
+    n_times = min(stop - start for start, stop in (store._window(int(n), tmin, None) for n in rows['n_times']))
+    for _, row in rows.iterrows():
+        epoch = np.asarray(store.get(row, tmin=tmin)[:, :n_times], dtype=np.float64)
+        yield row['subject'], epoch - epoch.mean(axis=1, keepdims=True)
+
+def accumulate(epochs):
+    # Single pass: Rw = sum_i X_i X_i^T and S = sum_i X_i, so Rb = S S^T - Rw without visiting subject pairs
+    rw, total, subjects = None, None, []
+    for subject, x in epochs:
+        rw = x @ x.T if rw is None else rw + x @ x.T
+        total = x.copy() if total is None else total + x
+        subjects.append(subject)
+    if len(subjects) < 2:
+        raise ValueError('ISC needs at least two subjects')
+    return rw, total @ total.T - rw, total, subjects
+
+def correlated_components(rw, rb, n_subjects, n_components=ISC_COMPONENTS, shrinkage=ISC_SHRINKAGE):
+    # Generalised eigenproblem Rb w = lambda Rw w; ISC of a component is lambda / (N - 1)
+    rw_reg = (1 - shrinkage) * rw + shrinkage * np.trace(rw) / len(rw) * np.eye(len(rw))
+    values, vectors = eigh(rb, rw_reg)
+    order = np.argsort(values)[::-1][:n_components]
+    w = vectors[:, order]
+    isc = np.diag(w.T @ rb @ w) / np.diag(w.T @ rw @ w) / (n_subjects - 1)
+    forward = rw @ w @ np.linalg.pinv(w.T @ rw @ w)  # Scalp projections for plotting
+    return w, forward, isc
+
+def window_sums(y, window, step):
+    # Sums of y over every window along the last axis from one cumulative sum
+    c = np.concatenate([np.zeros(y.shape[:-1] + (1,)), np.cumsum(y, axis=-1)], axis=-1)
+    starts = np.arange(0, y.shape[-1] - window + 1, step)
+    return c[..., starts + window] - c[..., starts]
+
+def time_resolved_isc(epochs, w, total, n_subjects, window, step):
+    # Second streaming pass on the projected sources y_i = w^T X_i; per window,
+    # within = sum_i var(y_i), between = var(sum_i y_i) - within, both centred inside the window
+    y_total = w.T @ total
+    summed = window_sums(y_total ** 2, window, step) - window_sums(y_total, window, step) ** 2 / window
+    within = np.zeros_like(summed)
+    per_subject = []
+    for subject, x in epochs:
+        y = w.T @ x
+        within += window_sums(y ** 2, window, step) - window_sums(y, window, step) ** 2 / window
+        others = y_total - y
+        per_subject.append([subject] + [np.corrcoef(y[c], others[c])[0, 1] for c in range(len(y))])
+    return (summed - within) / within / (n_subjects - 1), per_subject
+
+def marker_isc(store, marker, n_components=ISC_COMPONENTS, window=ISC_WINDOW, step=ISC_STEP, tmin=ISC_TMIN):
+    rw, rb, total, subjects = accumulate(marker_epochs(store, marker, tmin))
+    w, forward, isc = correlated_components(rw, rb, len(subjects), min(n_components, len(rw)))
+    window_samples, step_samples = int(round(window * store.sfreq)), max(1, int(round(step * store.sfreq)))
+    if total.shape[1] >= window_samples:
+        isc_t, per_subject = time_resolved_isc(marker_epochs(store, marker, tmin), w, total, len(subjects),
+                                               window_samples, step_samples)
+        times = tmin + (np.arange(isc_t.shape[1]) * step_samples + window_samples / 2) / store.sfreq
+    else:
+        isc_t, times, per_subject = np.empty((len(isc), 0)), np.empty(0), []
+    return {'w': w, 'forward': forward, 'isc': isc, 'isc_t': isc_t, 'times': times, 'subjects': subjects,
+            'per_subject': per_subject}
+
+def condition_isc(deriv_root, condition, n_components=ISC_COMPONENTS, window=ISC_WINDOW, step=ISC_STEP):
+    # One npz per ad under derivatives/isc/<condition>/ plus isc.csv (per ad) and isc_subjects.csv (leave-one-out)
+    store = EpochStore.from_derivatives(deriv_root, condition)
+    out_dir = isc_dir_for(deriv_root, condition)
+    os.makedirs(out_dir, exist_ok=True)
+    summary, subject_rows = [], []
+    for marker in sorted(store.index['marker'].dropna().unique()):
+        marker = int(marker)
+        try:
+            result = marker_isc(store, marker, n_components, window, step)
+        except ValueError as e:
+            print(f"Marker {marker}: {e}")
+            continue
+        np.savez(os.path.join(out_dir, f'marker-{marker}.npz'), ch_names=store.ch_names,
+                 **{k: np.asarray(v) for k, v in result.items() if k != 'per_subject'})
+        summary.append(dict({'marker': marker, 'n_subjects': len(result['subjects'])},
+                            **{f'isc_{c+1}': v for c, v in enumerate(result['isc'])}))
+        subject_rows += [dict({'marker': marker, 'subject': row[0]}, **{f'isc_{c+1}': v for c, v in enumerate(row[1:])})
+                         for row in result['per_subject']]
+        print(f"Marker {marker}: {len(result['subjects'])} subjects, ISC {np.round(result['isc'], 3)}")
+    pd.DataFrame(summary).to_csv(os.path.join(out_dir, 'isc.csv'), index=False)
+    pd.DataFrame(subject_rows).to_csv(os.path.join(out_dir, 'isc_subjects.csv'), index=False)
+    return pd.DataFrame(summary)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inter-subject correlation per ad from the epoch store')
+    parser.add_argument('--bids-root', default='../')
+    parser.add_argument('--condition', default='bigmood')
+    parser.add_argument('--components', type=int, default=ISC_COMPONENTS)
+    parser.add_argument('--window', type=float, default=ISC_WINDOW, help='Seconds per time-resolved ISC window')
+    parser.add_argument('--step', type=float, default=ISC_STEP)
+    args = parser.parse_args()
+
+    print(condition_isc(os.path.join(args.bids_root, 'derivatives'), args.condition, args.components, args.window,
+                        args.step).to_string(index=False))
@@ -0,0 +1,84 @@
+import os, hashlib, functools
+import numpy as np
+import mne
+from numpy.polynomial.legendre import legval
+
+ELP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standard-10-5-cap385.elp')
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.montage_cache')
+SPLINE_STIFFNESS = 4  # Perrin et al. (1989) spherical splines, same defaults as MNE's interpolate_bads
+SPLINE_TERMS = 7
+SPLINE_ALPHA = 1e-5
+
+def read_elp(path=ELP_PATH):
+    # BESA spherical coordinates (theta, phi in degrees, radius in mm) -> head-frame positions in meters
+    positions, fiducials = {}, {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 5:
+                continue
+            kind, label = parts[:2]
+            theta, phi, radius = np.radians(float(parts[2])), np.radians(float(parts[3])), float(parts[4]) / 1000
+            xyz = radius * np.array([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)])
+            (fiducials if kind == 'FID' else positions)[label] = xyz
+    return positions, fiducials
+
+@functools.lru_cache(maxsize=None)
+def _cached_montage(path):
+    positions, fiducials = read_elp(path)
+    return mne.channels.make_dig_montage(ch_pos=positions, nasion=fiducials.get('Nz'), lpa=fiducials.get('LPA'),
+                                         rpa=fiducials.get('RPA'), coord_frame='head')
+
+def load_montage(path=ELP_PATH):
+    # Parsed once per process; callers get a copy so the cached montage is never modified
+    return _cached_montage(path).copy()
+
+@functools.lru_cache(maxsize=None)
+def _elp_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _legendre_g(cosang):
+    factors = [(2 * n + 1) / (n ** SPLINE_STIFFNESS * (n + 1) ** SPLINE_STIFFNESS * 4 * np.pi)
+               for n in range(1, SPLINE_TERMS + 1)]
+    return legval(cosang, [0] + factors)
+
+def spline_matrix(pos_from, pos_to):
+    # (n_to, n_from) spherical-spline interpolation matrix between unit-normalised sensor positions
+    pos_from = pos_from / np.linalg.norm(pos_from, axis=1, keepdims=True)
+    pos_to = pos_to / np.linalg.norm(pos_to, axis=1, keepdims=True)
+    g_from = _legendre_g(np.clip(pos_from @ pos_from.T, -1, 1))
+    g_from.flat[::len(g_from) + 1] += SPLINE_ALPHA
+    g_to_from = _legendre_g(np.clip(pos_to @ pos_from.T, -1, 1))
+    n_from = len(pos_from)
+    system = np.block([[g_from, np.ones((n_from, 1))], [np.ones((1, n_from)), np.zeros((1, 1))]])
+    return np.hstack([g_to_from, np.ones((len(pos_to), 1))]) @ np.linalg.pinv(system)[:, :-1]
+
+@functools.lru_cache(maxsize=None)
+def interpolation_matrix(good, bad, path=ELP_PATH, cache_dir=CACHE_DIR):
+    # good and bad are tuples of channel names; matrices are kept on disk per (ELP file, subset)
+    key = hashlib.sha256(repr((_elp_digest(path), good, bad, SPLINE_STIFFNESS, SPLINE_TERMS,
+                               SPLINE_ALPHA)).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f'interp-{key}.npy')
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    positions, _ = read_elp(path)
+    lookup = {label.lower(): xyz for label, xyz in positions.items()}
+    missing = [ch for ch in good + bad if ch.lower() not in lookup]
+    if missing:
+        raise ValueError(f'Channels not in {os.path.basename(path)}: {missing}')
+    matrix = spline_matrix(np.array([lookup[ch.lower()] for ch in good]), np.array([lookup[ch.lower()] for ch in bad]))
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_path, matrix)
+    return matrix
+
+def interpolate_bads(data, ch_names, bads):
+    # data (..., n_channels, n_times) is modified in place: bad rows are rebuilt from the good ones
+    bad_idx = [ch_names.index(ch) for ch in bads]
+    good_idx = [i for i in range(len(ch_names)) if i not in bad_idx]
+    if not bad_idx or not good_idx:
+        return data
+    matrix = interpolation_matrix(tuple(ch_names[i] for i in good_idx), tuple(bads))
+    data[..., bad_idx, :] = matrix @ data[..., good_idx, :]
+    return data
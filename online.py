@@ -0,0 +1,182 @@
+import time, argparse, threading
+import numpy as np
+from pylsl import StreamInfo, StreamOutlet, StreamInlet, resolve_byprop, local_clock, proc_clocksync, IRREGULAR_RATE
+from scipy.signal import sosfilt, sosfilt_zi
+from filters import iir_sos
+from preprocess import HIGHPASS, LOWPASS
+from screening import rail_mask
+from features import BANDS, band_power
+from events import LEGO_VIDEO_DURATIONS
+from videos import condition_durations
+
+MARKER_STREAM = 'PsychoPyMarkers'  # Published by the PsychoPy scripts
+ONLINE_CHANNELS = 4  # Same as load_eeg_data's channel_limit
+ONLINE_WINDOW = 2.0  # Seconds of the latest filtered data behind each band-power update
+ONLINE_UPDATE = 0.5  # Seconds between metric updates of a running ad
+ONLINE_POLL = 0.005  # Seconds to sleep when nothing new arrived
+HISTORY_SECONDS = 5.0  # Filtered samples kept so a late marker can still claim the samples after its time stamp
+LATENCY_BUDGET_MS = 100.0
+METRICS_STREAM = 'FoxMetrics'
+METRIC_CHANNELS = ['marker', 'elapsed', 'final', 'ptp_max', 'rail_fraction', 'theta', 'alpha', 'beta', 'engagement',
+                   'latency_ms']
+
+class CausalFilter:
+    # Band-pass with the offline cut-offs, filtered chunk by chunk with the sosfilt state carried over.
+    # Causal, so phase differs from the zero-phase offline filter; band edges are the same.
+    def __init__(self, sfreq, l_freq=HIGHPASS, h_freq=LOWPASS):
+        self.sos = iir_sos(sfreq, l_freq, h_freq)
+        self.zi = None
+
+    def __call__(self, chunk):
+        # chunk (n_samples, n_channels); the state starts at the first sample to avoid a step transient
+        if self.zi is None:
+            self.zi = sosfilt_zi(self.sos)[:, :, None] * chunk[0][None, None, :]
+        out, self.zi = sosfilt(self.sos, chunk, axis=0, zi=self.zi)
+        return out
+
+class LiveEpoch:
+    # Running quality and band power for one ad, from its marker until its video duration has elapsed.
+    # Only running extremes, counts and the last ONLINE_WINDOW of samples are kept, not the whole epoch.
+    def __init__(self, marker, start, duration, n_channels, sfreq):
+        self.marker, self.start, self.end, self.sfreq = marker, start, start + duration, sfreq
+        self.n, self.railed = 0, 0
+        self.high, self.low = np.full(n_channels, -np.inf), np.full(n_channels, np.inf)
+        self.tail = np.empty((0, n_channels))
+        self.window = int(ONLINE_WINDOW * sfreq)
+        self.power_sum, self.n_updates = np.zeros(len(BANDS)), 0
+        self.next_update = start + ONLINE_UPDATE
+
+    def add(self, stamps, filtered, railed):
+        keep = (stamps >= self.start) & (stamps < self.end)
+        if keep.any():
+            data = filtered[keep]
+            self.n += len(data)
+            self.railed += int(railed[keep].sum())
+            self.high, self.low = np.maximum(self.high, data.max(axis=0)), np.minimum(self.low, data.min(axis=0))
+            self.tail = np.concatenate([self.tail, data])[-self.window:]
+        return len(stamps) > 0 and stamps[-1] >= self.end
+
+    def metrics(self, stamp, final, latency_ms):
+        if final and self.n_updates:
+            power = self.power_sum / self.n_updates
+        elif len(self.tail) >= self.sfreq:
+            power = band_power(self.tail.T, self.sfreq).mean(axis=0)
+            self.power_sum += power
+            self.n_updates += 1
+        else:
+            power = np.full(len(BANDS), np.nan)
+        theta, alpha, beta = (power[list(BANDS).index(band)] for band in ('theta', 'alpha', 'beta'))
+        ptp = float((self.high - self.low).max()) if self.n else np.nan
+        rail_fraction = self.railed / max(1, self.n * len(self.high))
+        return [float(self.marker), min(stamp, self.end) - self.start, float(final), ptp, rail_fraction,
+                theta, alpha, beta, beta / (alpha + theta), latency_ms]
+
+def open_inlets(timeout=10.0):
+    eeg = resolve_byprop('type', 'EEG', timeout=timeout)
+    markers = resolve_byprop('name', MARKER_STREAM, timeout=timeout)
+    if not eeg:
+        raise ValueError('No EEG stream found on the network')
+    if not markers:
+        raise ValueError(f'No {MARKER_STREAM} stream found on the network')
+    # Clock synchronisation is applied by liblsl, so both streams arrive on the local clock
+    return StreamInlet(eeg[0], processing_flags=proc_clocksync), StreamInlet(markers[0], processing_flags=proc_clocksync)
+
+def metrics_outlet():
+    info = StreamInfo(METRICS_STREAM, 'Metrics', len(METRIC_CHANNELS), IRREGULAR_RATE, 'float32', 'foxmetrics')
+    channels = info.desc().append_child('channels')
+    for label in METRIC_CHANNELS:
+        channels.append_child('channel').append_child_value('label', label)
+    return StreamOutlet(info)
+
+def run(eeg_inlet, marker_inlet, outlet, durations=LEGO_VIDEO_DURATIONS, seconds=None, n_channels=ONLINE_CHANNELS):
+    # Pull, filter, cut and push until seconds have passed (forever if None); returns latency statistics in ms,
+    # measured from the newest sample's time stamp to the end of its processing
+    sfreq = eeg_inlet.info().nominal_srate()
+    n_channels = min(n_channels, eeg_inlet.info().channel_count())
+    causal_filter = CausalFilter(sfreq)
+    history_stamps, history, history_rail = np.empty(0), np.empty((0, n_channels)), np.empty((0, n_channels), bool)
+    active, latencies = [], []
+    stop_at = None if seconds is None else local_clock() + seconds
+    while stop_at is None or local_clock() < stop_at:
+        samples, stamps = eeg_inlet.pull_chunk(timeout=0.0)
+        markers, marker_stamps = marker_inlet.pull_chunk(timeout=0.0)
+        if not samples and not markers:
+            time.sleep(ONLINE_POLL)
+            continue
+
+        if samples:
+            raw = np.asarray(samples, dtype=np.float64)[:, :n_channels]
+            stamps = np.asarray(stamps)
+            filtered, railed = causal_filter(raw), rail_mask(raw)
+            keep = np.concatenate([history_stamps, stamps]) >= stamps[-1] - HISTORY_SECONDS
+            history_stamps = np.concatenate([history_stamps, stamps])[keep]
+            history = np.concatenate([history, filtered])[keep]
+            history_rail = np.concatenate([history_rail, railed])[keep]
+            done = [epoch for epoch in active if epoch.add(stamps, filtered, railed)]
+        else:
+            done = []
+
+        for marker, stamp in zip(markers, marker_stamps):
+            if marker and marker[0] in durations:
+                epoch = LiveEpoch(int(marker[0]), stamp, float(durations[marker[0]]), n_channels, sfreq)
+                if epoch.add(history_stamps, history, history_rail):
+                    done.append(epoch)
+                active.append(epoch)
+                print(f"Marker {marker[0]}: ad started")
+
+        if len(history_stamps):
+            latest = history_stamps[-1]
+            latency = (local_clock() - latest) * 1e3
+            for epoch in active:
+                if epoch in done:
+                    outlet.push_sample(epoch.metrics(latest, True, latency), latest)
+                    print(f"Marker {epoch.marker}: ad finished, {epoch.n / sfreq:.1f} s")
+                elif latest >= epoch.next_update:
+                    outlet.push_sample(epoch.metrics(latest, False, latency), latest)
+                    epoch.next_update += ONLINE_UPDATE
+            active = [epoch for epoch in active if epoch not in done]
+            if samples:
+                latencies.append((local_clock() - latest) * 1e3)
+
+    latencies = np.array(latencies)
+    stats = {'chunks': len(latencies), 'median_ms': float(np.median(latencies)) if len(latencies) else np.nan,
+             'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else np.nan,
+             'max_ms': float(latencies.max()) if len(latencies) else np.nan}
+    if stats['p95_ms'] > LATENCY_BUDGET_MS:
+        print(f"95th percentile latency {stats['p95_ms']:.1f} ms is over the {LATENCY_BUDGET_MS:.0f} ms budget")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Live filtering, ad epochs and metrics from LSL EEG and PsychoPy markers')
+    parser.add_argument('--seconds', type=float, default=None, help='Stop after this long (default: run until killed)')
+    parser.add_argument('--channels', type=int, default=ONLINE_CHANNELS)
+    parser.add_argument('--lists-dir', default=None, help='PsychoPy folder with lists*.xlsx and videos/')
+    parser.add_argument('--show', default=None, help='Show played in this condition, e.g. LEGO or BigMood')
+    parser.add_argument('--fallback-lego', action='store_true',
+                        help='Use the LEGO durations if no video of the playlist is found under --lists-dir')
+    parser.add_argument('--synthetic', type=float, default=None,
+                        help='Start a local synthetic EEG and marker outlet of this many seconds and run against it')
+    args = parser.parse_args()
+
+    # Same rule as events.py: the LEGO table only without a lists folder, or on request
+    durations = LEGO_VIDEO_DURATIONS
+    if args.lists_dir:
+        try:
+            durations = condition_durations(args.lists_dir, args.show)
+        except FileNotFoundError as e:
+            if not args.fallback_lego:
+                parser.error(f"{e} (pass --fallback-lego to use the LEGO durations anyway)")
+            print(f"{e}; using the LEGO durations")
+
+    stop = threading.Event()
+    if args.synthetic:
+        from bench.synthetic import stream_lsl
+        threading.Thread(target=stream_lsl, args=(args.synthetic,), kwargs={'stop': stop}, daemon=True).start()
+    eeg_inlet, marker_inlet = open_inlets()
+    try:
+        stats = run(eeg_inlet, marker_inlet, metrics_outlet(), durations, seconds=args.seconds or args.synthetic,
+                    n_channels=args.channels)
+    finally:
+        stop.set()
+    print(f"{stats['chunks']} chunks, latency median {stats['median_ms']:.1f} ms, "
+          f"p95 {stats['p95_ms']:.1f} ms, max {stats['max_ms']:.1f} ms")
@@ -1,78 +1,475 @@
-import os, re, mne
+import os, re, time, json, shutil, hashlib, argparse, mne
 import numpy as np
 import pandas as pd
-from pyxdf import load_xdf
 from mne.preprocessing import ICA
-from scipy.stats import zscore
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from xdfio import load_xdf_cached, load_stream
+from filters import filter_data, resample_data, filter_memmap
+from profiling import StageProfiler, NullProfiler, aggregate_profiles
+from epoch_store import store_dir_for, write_shard, consolidate
+from screening import rail_mask, screen_epochs, screen_params
+from montage import load_montage, interpolate_bads
+from group_ica import (group_dir_for, group_model_path, fit_group_model, save_group_model, load_group_model,
+                       group_source_transform, remove_components)
 
 HIGHPASS = 0.3  # Low cutoff 
 LOWPASS = 50.0  # High cutoff 
+RESAMPLE_SFREQ = None  # e.g. 125.0 to decimate after the low-pass; None keeps the recording rate
+FILTER_METHOD = 'fir'  # 'fir': cached zero-phase FIR with overlap-add blocks, 'iir': zero-phase Butterworth SOS
 Z_THRESHOLD = 1.96  # Threshold for z-score to exclude ICA components
+EXCLUDE_FRACTION = 0.1  # Exclude a component when more than this fraction of its samples cross Z_THRESHOLD;
+                        # a Gaussian source crosses 1.96 about 5% of the time
+ICA_MODE = 'recording'  # 'recording': one ICA per file applied to every event, 'event': one ICA per event,
+                        # 'group': one incremental ICA per condition across subjects (group_ica.py)
+ICA_COMPONENTS = 2
+ICA_SEED = 97
+SCREEN = True  # Screen epochs before ICA: clean ones skip it, unusable ones are dropped (screening.py)
+INTERPOLATE_BADS = True  # Rebuild channels marked bad by the screen with cached spherical-spline matrices
+EPOCH_TMIN = -0.5  # Pre-stimulus window in seconds, also used as baseline
+XDF_CACHE = True  # Decode each XDF once into a memory-mapped sidecar cache
+SAVE_FORMAT = 'store'  # 'store': per-condition epoch store (epoch_store.py), 'fif': one _epo.fif per event, 'both'
+ZSCORE_CHUNK = 2 ** 16  # Samples per block when streaming ICA sources for component rejection
+MANIFEST_FILE = 'manifest.json'  # Records inputs and parameters of every output under derivatives/preprocessing
 
-def load_eeg_data(file_path, channel_limit=4):
-    data, _ = load_xdf(file_path)
-    eeg_stream = next((s for s in data if s['info']['type'][0] == 'EEG'), None)
-    if eeg_stream is None:
-        raise ValueError('No EEG stream found in file: ' + file_path)
+def load_eeg_stream(file_path, channel_limit=4, use_cache=XDF_CACHE):
+    # (n_times, n_channels) float32 samples (memory-mapped from the cache), channel names and sampling rate
+    if use_cache:
+        data = load_xdf_cached(file_path)
+        eeg_stream = next((s for s in data if s['info']['type'][0] == 'EEG'), None)
+        if eeg_stream is None:
+            raise ValueError('No EEG stream found in file: ' + file_path)
+    else:
+        # Decode only the EEG stream and the channels we keep
+        eeg_stream = load_stream(file_path, 'EEG', channels=range(channel_limit))
 
-    eeg_data = eeg_stream['time_series'][:, :channel_limit].T
+    time_series = eeg_stream['time_series'][:, :channel_limit]
     channel_names = [ch['label'][0] for ch in eeg_stream['info']['desc'][0]['channels'][0]['channel'][:channel_limit]]
-    sfreq = float(eeg_stream['info']['nominal_srate'][0])
+    return time_series, channel_names, float(eeg_stream['info']['nominal_srate'][0])
+
+def load_eeg_data(file_path, channel_limit=4, use_cache=XDF_CACHE):
+    time_series, channel_names, sfreq = load_eeg_stream(file_path, channel_limit, use_cache)
+    eeg_data = time_series.T
     info = mne.create_info(ch_names=channel_names, sfreq=sfreq, ch_types='eeg')
     return mne.io.RawArray(eeg_data, info), sfreq
 
-def preprocess_subject(subject_id, task, bids_root, deriv_root):
+def preprocess_subject(subject_id, task, bids_root, deriv_root, condition=None):
+    condition = condition or task
     subject_dir = os.path.join(bids_root, f'sub-{subject_id}_{task}')
     xdf_files = [f for f in os.listdir(subject_dir) if f.endswith('.xdf')]
 
+    manifest = load_manifest(deriv_root)
     for file_name in xdf_files:
         file_path = os.path.join(subject_dir, file_name)
+        key = manifest_key(subject_id, condition, file_path)
+        manifest[key], _ = preprocess_file(file_path, subject_id, task, bids_root, deriv_root, condition,
+                                           previous=manifest.get(key))
+        save_manifest(deriv_root, manifest)
+
+def manifest_key(subject_id, condition, file_path):
+    return f'sub-{subject_id}_{condition}/{os.path.basename(file_path)}'
+
+def load_manifest(deriv_root):
+    path = os.path.join(deriv_root, 'preprocessing', MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(deriv_root, manifest):
+    path = os.path.join(deriv_root, 'preprocessing', MANIFEST_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def file_hash(path, previous=None):
+    # Re-hash only when size or mtime changed since the last run
+    stat = os.stat(path)
+    if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'sha256': digest.hexdigest(), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def params_hash(*items):
+    return hashlib.sha256(json.dumps(items, sort_keys=True).encode()).hexdigest()
+
+def ica_params():
+    # Everything that changes the data the ICA is fitted on, or the fit itself. The screen decides which
+    # epochs go to ICA and which channels are left out of the recording fit.
+    return dict({'HIGHPASS': HIGHPASS, 'LOWPASS': LOWPASS, 'FILTER_METHOD': FILTER_METHOD,
+                 'RESAMPLE_SFREQ': RESAMPLE_SFREQ, 'SCREEN': SCREEN, 'MONTAGE': 'standard-10-5-cap385.elp',
+                 'EPOCH_TMIN': EPOCH_TMIN, 'ICA_MODE': ICA_MODE, 'ICA_COMPONENTS': ICA_COMPONENTS,
+                 'ICA_SEED': ICA_SEED}, **screen_params())
+
+def preprocess_file(file_path, subject_id, task, bids_root, deriv_root, condition=None, previous=None, profiler=None,
+                    save_format=SAVE_FORMAT):
+    # Returns the manifest entry for this recording and whether the outputs were already current
+    condition = condition or task
+    previous = previous or {}
+    profiler = profiler or NullProfiler()
+    subject_dir = os.path.join(bids_root, f'sub-{subject_id}_{task}')
+    csv_path = os.path.join(subject_dir, f'sub-{subject_id}_task-events.csv')
+    xdf_hash = file_hash(file_path, previous.get('xdf'))
+    events_hash = file_hash(csv_path, previous.get('events'))
+
+    params = dict(ica_params(), Z_THRESHOLD=Z_THRESHOLD, EXCLUDE_FRACTION=EXCLUDE_FRACTION, SAVE_FORMAT=save_format,
+                  INTERPOLATE_BADS=INTERPOLATE_BADS)
+    # A refitted group model changes every output of the condition
+    group_hash = file_hash(group_model_path(deriv_root, condition))['sha256'] if ICA_MODE == 'group' else None
+    ica_key = params_hash(xdf_hash['sha256'], events_hash['sha256'], ica_params(), group_hash)
+    key = params_hash(ica_key, params)
+    if previous.get('key') == key and all(os.path.exists(f) for f in previous['outputs']):
+        print(f"Outputs are current, skipping: {file_path}")
+        return previous, True
+
+    with profiler.stage('load') as record:
         raw, sfreq = load_eeg_data(file_path)
-        csv_path = os.path.join(subject_dir, f'sub-{subject_id}_task-events.csv')
-        events_df = pd.read_csv(csv_path)
-        raw.set_montage(mne.channels.make_standard_montage('standard_1020'), match_case=False)
-        raw.filter(HIGHPASS, LOWPASS)
-        preprocess_events(raw, sfreq, events_df, subject_id, condition, deriv_root)
+        record.update(raw_shape=[len(raw.ch_names), int(raw.n_times)],
+                      raw_mb=round(len(raw.ch_names) * raw.n_times * 8 / 1024 ** 2, 2))
+    events_df = pd.read_csv(csv_path)
+    with profiler.stage('montage'):
+        raw.set_montage(load_montage(), match_case=False)
+    rail = rail_mask(raw._data) if SCREEN else None  # Not get_data(): that copies the recording
+    with profiler.stage('filter'):
+        raw.apply_function(lambda x: filter_data(x, sfreq, HIGHPASS, LOWPASS, FILTER_METHOD, out=x), channel_wise=False)
+    if RESAMPLE_SFREQ and RESAMPLE_SFREQ != sfreq:
+        with profiler.stage('resample') as record:
+            raw, events_df = resample_recording(raw, events_df, sfreq, RESAMPLE_SFREQ)
+            if rail is not None:
+                rail = rail[:, (np.arange(raw.n_times) * sfreq / RESAMPLE_SFREQ).astype(int)]
+            sfreq = RESAMPLE_SFREQ
+            record.update(raw_shape=[len(raw.ch_names), int(raw.n_times)])
+    # Only the component rejection changed: reuse the ICA solutions saved by the previous run
+    reuse_ica = previous.get('ica_key') == ica_key
+    outputs = preprocess_events(raw, sfreq, events_df, subject_id, condition, deriv_root, reuse_ica=reuse_ica,
+                                profiler=profiler, save_format=save_format, rail=rail)
+    entry = {'xdf': xdf_hash, 'events': events_hash, 'params': params, 'ica_key': ica_key, 'key': key,
+             'outputs': outputs}
+    return entry, False
+
+def resample_recording(raw, events_df, sfreq, new_sfreq):
+    # Events CSV onsets and durations are in samples, so they are rescaled to the new rate too
+    data = resample_data(raw.get_data(), sfreq, new_sfreq)
+    resampled = mne.io.RawArray(data, mne.create_info(raw.ch_names, new_sfreq, ch_types='eeg'))
+    resampled.set_montage(raw.get_montage())
+    events_df = events_df.copy()
+    for column in ('onset', 'duration'):
+        events_df[column] = np.round(events_df[column] * new_sfreq / sfreq).astype(int)
+    return resampled, events_df
+
+def epoch_events(data, sfreq, events_df, tmin=EPOCH_TMIN):
+    # Every event window as a (n_channels, lengths[i]) view into the (n_channels, n_times) buffer, so epoching
+    # copies nothing however many ads there are. lengths[i] is 0, and the view empty, for events whose
+    # window falls outside the recording.
+    n_times = data.shape[1]
+    starts = events_df['onset'].to_numpy(dtype=np.int64) + int(round(tmin * sfreq))
+    lengths = events_df['duration'].to_numpy(dtype=np.int64) - int(round(tmin * sfreq)) + 1
+    lengths[(starts < 0) | (starts + lengths > n_times)] = 0
+    return [data[:, start:start + length] if length else data[:, :0]
+            for start, length in zip(starts, lengths)], lengths
+
+def fit_ica(inst, picks=None):
+    ica = ICA(n_components=ICA_COMPONENTS, random_state=ICA_SEED)
+    ica.fit(inst, picks=picks)
+    return ica
+
+def source_transform(ica):
+    # Pre-whitening, PCA and unmixing folded into one float32 (n_components, n_channels) matrix and offset
+    unmixing = ica.unmixing_matrix_ @ ica.pca_components_[:ica.n_components_]
+    matrix = unmixing / ica.pre_whitener_.ravel()[None, :]
+    offset = unmixing @ ica.pca_mean_ if ica.pca_mean_ is not None else np.zeros(len(matrix))
+    return matrix.astype(np.float32), offset.astype(np.float32)[:, None]
+
+def reject_components(transform, data, threshold=Z_THRESHOLD, chunk=ZSCORE_CHUNK):
+    # Per-component z-scores over time without materializing sources or z-scores: one Welford pass
+    # (Chan's merge per block) for mean and std, one pass counting samples with |z| > threshold.
+    # transform is (matrix, offset) from source_transform or group_source_transform, data is
+    # (n_channels, n_times); returns the exceedance count of every component.
+    matrix, offset = transform
+    blocks = [(start, min(start + chunk, data.shape[1])) for start in range(0, data.shape[1], chunk)]
+    count, mean, m2 = 0, np.zeros((len(matrix), 1)), np.zeros((len(matrix), 1))
+    for start, stop in blocks:
+        sources = matrix @ data[:, start:stop].astype(np.float32) - offset
+        n = stop - start
+        block_mean = sources.mean(axis=1, keepdims=True, dtype=np.float64)
+        block_m2 = ((sources - block_mean) ** 2).sum(axis=1, keepdims=True, dtype=np.float64)
+        delta = block_mean - mean
+        mean = mean + delta * n / (count + n)
+        m2 = m2 + block_m2 + delta ** 2 * count * n / (count + n)
+        count += n
+    std = np.sqrt(m2 / max(count, 1))
+
+    exceed = np.zeros(len(matrix), dtype=np.int64)
+    lower, upper = (mean - threshold * std).astype(np.float32), (mean + threshold * std).astype(np.float32)
+    for start, stop in blocks:
+        sources = matrix @ data[:, start:stop].astype(np.float32) - offset
+        exceed += ((sources < lower) | (sources > upper)).sum(axis=1)
+    return exceed
+
+def select_components(exceed, n_samples, fraction=EXCLUDE_FRACTION):
+    return [int(c) for c in np.flatnonzero(exceed > fraction * n_samples)]
+
+def load_or_fit_ica(inst, fname, reuse=False, picks=None):
+    if reuse and os.path.exists(fname):
+        return mne.preprocessing.read_ica(fname)
+    ica = fit_ica(inst, picks)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    ica.save(fname, overwrite=True)
+    return ica
+
+def preprocess_events(raw, sfreq, events_df, subject_id, condition, deriv_root, ica_mode=ICA_MODE, reuse_ica=False,
+                      profiler=None, save_format=SAVE_FORMAT, rail=None, screen=SCREEN):
+    if ica_mode not in ('recording', 'event', 'group'):
+        raise ValueError(f'Unknown ICA mode: {ica_mode}')
+    if save_format not in ('fif', 'store', 'both'):
+        raise ValueError(f'Unknown save format: {save_format}')
+    profiler = profiler or NullProfiler()
+    preprocessing_dir = os.path.join(deriv_root, 'preprocessing', f'sub-{subject_id}_{condition}')
+    ica_dir = os.path.join(preprocessing_dir, 'ica')
+
+    outputs, store_epochs, store_rows = [], [], []
+    with profiler.stage('epoch') as record:
+        epochs_data, lengths = epoch_events(raw._data, sfreq, events_df)  # No get_data(): it copies the recording
+        record.update(n_events=len(lengths))
+    bad = np.zeros((len(lengths), len(raw.ch_names)), dtype=bool)
+    actions = np.where(lengths > 0, 'ica', 'drop').astype(object)
+    if screen:
+        with profiler.stage('screen') as record:
+            rail_epochs = epoch_events(rail, sfreq, events_df)[0] if rail is not None else None
+            result = screen_epochs(epochs_data, lengths, sfreq, rail_epochs, min_good=ICA_COMPONENTS)
+            bad, actions = result['bad'], result['action']
+            record.update(actions=list(actions))
+        print(f"Screening: {(actions == 'clean').sum()} clean, {(actions == 'ica').sum()} need ICA, "
+              f"{(actions == 'drop').sum()} unusable")
+
+    # Fit once on the continuous filtered recording; the unmixing matrix is reused for every event.
+    # Channels that are broken in any epoch sent to ICA are left out of the decomposition (raw.info is not
+    # touched); if that leaves too few, every channel is used and the epochs with bad ICA channels are dropped.
+    if ica_mode == 'recording' and (actions == 'ica').any():
+        recording_bads = {raw.ch_names[c] for c in np.flatnonzero(bad[actions == 'ica'].any(axis=0))}
+        good = [ch for ch in raw.ch_names if ch not in raw.info['bads']]
+        if len([ch for ch in good if ch not in recording_bads]) >= ICA_COMPONENTS:
+            good = [ch for ch in good if ch not in recording_bads]
+        with profiler.stage('ica_fit'):
+            ica = load_or_fit_ica(raw, os.path.join(ica_dir, f'sub-{subject_id}_{condition}_recording-ica.fif'),
+                                  reuse_ica, picks=good)
+    # The group model is fitted once per condition on every channel; channels bad in an epoch are rebuilt
+    # by interpolation after the components are removed
+    elif ica_mode == 'group' and (actions == 'ica').any():
+        model = load_group_model(group_model_path(deriv_root, condition))
+        if model['ch_names'] != raw.ch_names:
+            raise ValueError(f"Group ICA channels {model['ch_names']} do not match the recording {raw.ch_names}")
 
-def preprocess_events(raw, sfreq, events_df, subject_id, condition, deriv_root):
     for index, row in events_df.iterrows():
-        onset = row['onset'] / sfreq
-        duration = row['duration'] / sfreq
-        annotations = mne.Annotations(onset=[onset], duration=[duration], description=['event'])
-        raw_temp = raw.copy().set_annotations(annotations)
-        events, event_id_map = mne.events_from_annotations(raw_temp, event_id={'event': 1})
-
-        epochs = mne.Epochs(raw_temp, events, event_id=event_id_map, tmin=-0.5, tmax=duration, 
-                            baseline=None, preload=True)
-        ica = ICA(n_components=2, random_state=97)
-        ica.fit(epochs)
-        #ica.plot_components()
-        ica_data = ica.get_sources(epochs).get_data()
-
-        z_scores = zscore(ica_data, axis=1)
-        ica.exclude = np.where((np.abs(z_scores) > Z_THRESHOLD).any(axis=1))[0]
-        epochs_clean = ica.apply(epochs.copy()).apply_baseline((-0.5, 0)) # AFTER ICA
-
-        preprocessing_dir = os.path.join(deriv_root, 'preprocessing', f'sub-{subject_id}_{condition}')
-        os.makedirs(preprocessing_dir, exist_ok=True)
-        cleaned_fname = os.path.join(preprocessing_dir, f'sub-{subject_id}_{condition}_event-{index+1}_epo.fif')
-        epochs_clean.save(cleaned_fname, overwrite=True)
-        print(f"Cleaned epochs saved to: {cleaned_fname}")
+        if lengths[index] == 0:
+            print(f"Skipping event {index+1}: window exceeds the recording")
+            continue
+        if actions[index] == 'drop':
+            print(f"Dropping event {index+1}: too few usable channels")
+            continue
+        events = np.array([[int(row['onset']), 0, 1]])
+        # Bads are marked on this epoch only, so a channel broken during one ad is kept in the others
+        info = raw.info.copy()
+        info['bads'] = sorted(set(raw.info['bads']) | {raw.ch_names[c] for c in np.flatnonzero(bad[index])})
+        if actions[index] == 'ica' and ica_mode == 'recording' and set(info['bads']) & set(ica.ch_names):
+            print(f"Dropping event {index+1}: bad channels were part of the recording ICA")
+            continue
+        # The only copy of this event's samples; everything below works on it in place
+        epochs = mne.EpochsArray(epochs_data[index][None].copy(), info, events=events,
+                                 tmin=EPOCH_TMIN, event_id={'event': 1}, baseline=None)
 
-if __name__ == "__main__":
-    BIDS_ROOT = "../"
-    DERIV_ROOT = os.path.join(BIDS_ROOT, 'derivatives')
-    condition = 'bigmood'  ## CONDITION ##
-    subject_folders = [d for d in os.listdir(BIDS_ROOT) if d.startswith('sub-') and condition in d]
+        excluded = []
+        if actions[index] == 'ica' and ica_mode == 'group':
+            with profiler.stage('zscore', event=index+1) as record:
+                exceed = reject_components(group_source_transform(model), epochs_data[index])
+                excluded = select_components(exceed, lengths[index])
+                record.update(exceedances=exceed.tolist())
+            with profiler.stage('apply', event=index+1):
+                epochs_clean = epochs
+                epochs_clean.apply_function(lambda x: remove_components(model, x, excluded), picks='all',
+                                            channel_wise=False)
+        elif actions[index] == 'ica':
+            if ica_mode == 'event':
+                with profiler.stage('ica_fit', event=index+1):
+                    ica = load_or_fit_ica(epochs, os.path.join(ica_dir, f'sub-{subject_id}_{condition}_event-{index+1}-ica.fif'),
+                                          reuse_ica)
+            #ica.plot_components()
+            with profiler.stage('zscore', event=index+1) as record:
+                picks = [raw.ch_names.index(ch) for ch in ica.ch_names]
+                exceed = reject_components(source_transform(ica), epochs_data[index][picks])
+                ica.exclude = excluded = select_components(exceed, lengths[index])
+                record.update(exceedances=exceed.tolist())
+            with profiler.stage('apply', event=index+1):
+                epochs_clean = ica.apply(epochs)
+        else:
+            epochs_clean = epochs
+        with profiler.stage('baseline', event=index+1):
+            epochs_clean.apply_baseline((EPOCH_TMIN, 0)) # AFTER ICA
+        if INTERPOLATE_BADS and epochs_clean.info['bads']:
+            with profiler.stage('interpolate', event=index+1):
+                bads = list(epochs_clean.info['bads'])
+                epochs_clean.apply_function(lambda x: interpolate_bads(x, epochs_clean.ch_names, bads), picks='all',
+                                            channel_wise=False)
+                epochs_clean.info['bads'] = []
+
+        if save_format in ('store', 'both'):
+            store_epochs.append(epochs_clean.get_data()[0].astype(np.float32))
+            store_rows.append({'subject': subject_id, 'event': index+1, 'marker': row.get('event_id'),
+                               'onset': int(row['onset']), 'duration': int(row['duration']),
+                               'exclude': ';'.join(str(c) for c in excluded)})
+        if save_format in ('fif', 'both'):
+            os.makedirs(preprocessing_dir, exist_ok=True)
+            cleaned_fname = os.path.join(preprocessing_dir, f'sub-{subject_id}_{condition}_event-{index+1}_epo.fif')
+            with profiler.stage('save', event=index+1):
+                epochs_clean.save(cleaned_fname, overwrite=True)
+            outputs.append(cleaned_fname)
+            print(f"Cleaned epochs saved to: {cleaned_fname}")
+
+    if save_format in ('store', 'both'):
+        with profiler.stage('save') as record:
+            shard = write_shard(store_dir_for(deriv_root, condition), f'sub-{subject_id}_{condition}', store_epochs,
+                                store_rows, raw.ch_names, sfreq, EPOCH_TMIN)
+        outputs.append(shard)
+        print(f"Cleaned epochs added to store shard: {shard}")
+    return outputs
 
+def find_jobs(bids_root, condition):
+    jobs = []
+    subject_folders = sorted(d for d in os.listdir(bids_root) if d.startswith('sub-') and condition in d)
     for subject_folder in subject_folders:
         subject_match = re.match(r'sub-(\d{3})_(.*)', subject_folder)
         if subject_match:
             subject_id = subject_match.group(1)
             task = subject_match.group(2)
+            subject_dir = os.path.join(bids_root, subject_folder)
+            xdf_files = sorted(f for f in os.listdir(subject_dir) if f.endswith('.xdf'))
+            jobs += [(subject_id, task, os.path.join(subject_dir, f)) for f in xdf_files]
+    return jobs
 
+def fit_group_ica(jobs, deriv_root, condition):
+    # Each recording is filtered like preprocess_file, but straight from the cached float32 stream into a
+    # float32 scratch memmap (filter_memmap), so no float64 copy of a recording is ever made and the fit
+    # only holds one block or minibatch of the cohort in memory
+    scratch_dir = os.path.join(group_dir_for(deriv_root, condition), 'filtered')
+    os.makedirs(scratch_dir, exist_ok=True)
+    recordings, ch_names, rates = [], None, set()
+    try:
+        for subject_id, _, file_path in jobs:
+            time_series, names, sfreq = load_eeg_stream(file_path)
+            if ch_names is not None and names != ch_names:
+                raise ValueError(f'Channels of {file_path} differ from the rest of the condition: {names}')
+            ch_names = names
+            stem = os.path.splitext(os.path.basename(file_path))[0]
+            path = os.path.join(scratch_dir, f'sub-{subject_id}_{stem}.npy')
+            filtered = filter_memmap(time_series, path, sfreq, HIGHPASS, LOWPASS, FILTER_METHOD)
+            if RESAMPLE_SFREQ and RESAMPLE_SFREQ != sfreq:
+                resampled = resample_data(filtered.T, sfreq, RESAMPLE_SFREQ).astype(np.float32).T
+                del filtered
+                np.save(path, resampled)
+                del resampled
+                sfreq = RESAMPLE_SFREQ
+            else:
+                del filtered
+            del time_series
+            rates.add(sfreq)
+            recordings.append(np.load(path, mmap_mode='r').T)
+        if not recordings:
+            raise FileNotFoundError(f'No recordings to fit a group ICA for {condition}')
+        if len(rates) > 1:
+            raise ValueError(f'Recordings of {condition} have different sampling rates: {sorted(rates)}')
+        model = fit_group_model(recordings, ch_names, rates.pop(), ICA_SEED, params=ica_params(),
+                                sources=[manifest_key(s, condition, f) for s, _, f in jobs])
+    finally:
+        del recordings
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return save_group_model(group_model_path(deriv_root, condition), model)
+
+def profile_path(deriv_root, subject_id, condition, file_path):
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(deriv_root, 'logs', f'sub-{subject_id}_{condition}_{stem}_profile.json')
+
+def run_job(job, bids_root, deriv_root, condition, previous=None, profile=False, save_format=SAVE_FORMAT):
+    subject_id, task, file_path = job
+    start = time.perf_counter()
+    entry = None
+    profiler = StageProfiler(subject=subject_id, condition=condition, file=os.path.basename(file_path)) if profile else None
+    try:
+        entry, skipped = preprocess_file(file_path, subject_id, task, bids_root, deriv_root, condition, previous,
+                                         profiler, save_format)
+        status, error = 'current' if skipped else 'ok', ''
+    except FileNotFoundError as e:
+        print(e)
+        status, error = 'missing', str(e)
+    # The profile is only a log: failing to write it must not change the job's status or lose its entry
+    if profiler is not None and profiler.stages:
+        try:
+            profiler.save(profile_path(deriv_root, subject_id, condition, file_path))
+        except Exception as e:
+            print(f"Could not write the profile of {file_path}: {e!r}")
+    return status, error, time.perf_counter() - start, entry
+
+def run_jobs(jobs, bids_root, deriv_root, condition, n_jobs=1, profile=False, save_format=SAVE_FORMAT):
+    # Each XDF file is an independent job; a failure in one worker is recorded and the rest keep going.
+    # Workers return their manifest entries and only this process writes the manifest.
+    results = []
+    manifest = load_manifest(deriv_root)
+    def record(job, status, error, elapsed, entry=None):
+        subject_id, _, file_path = job
+        if entry is not None:
+            manifest[manifest_key(subject_id, condition, file_path)] = entry
+            save_manifest(deriv_root, manifest)
+        results.append({'subject': subject_id, 'file': os.path.basename(file_path),
+                        'status': status, 'seconds': round(elapsed, 1), 'error': error})
+        print(f"[{len(results)}/{len(jobs)}] sub-{subject_id} {os.path.basename(file_path)}: {status} ({elapsed:.1f} s)")
+
+    if n_jobs == 1:
+        for job in jobs:
+            start = time.perf_counter()
             try:
-                preprocess_subject(subject_id, task, BIDS_ROOT, DERIV_ROOT)
-            except FileNotFoundError as e:
-                print(e)
+                previous = manifest.get(manifest_key(job[0], condition, job[2]))
+                record(job, *run_job(job, bids_root, deriv_root, condition, previous, profile, save_format))
+            except Exception as e:
+                record(job, 'failed', repr(e), time.perf_counter() - start)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {pool.submit(run_job, job, bids_root, deriv_root, condition,
+                                   manifest.get(manifest_key(job[0], condition, job[2])), profile, save_format):
+                       (job, time.perf_counter())
+                       for job in jobs}
+            for future in as_completed(futures):
+                job, start = futures[future]
+                try:
+                    record(job, *future.result())
+                except Exception as e:
+                    record(job, 'failed', repr(e), time.perf_counter() - start)
+    return pd.DataFrame(results, columns=['subject', 'file', 'status', 'seconds', 'error'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Preprocess XDF recordings into cleaned epochs')
+    parser.add_argument('--bids-root', default='../')
+    parser.add_argument('--condition', default='bigmood')  ## CONDITION ##
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--profile', action='store_true', help='Write per-stage timing logs to derivatives/logs')
+    parser.add_argument('--save-format', choices=['store', 'fif', 'both'], default=SAVE_FORMAT,
+                        help='Epoch store read by features/tfr/isc/stats, per-event _epo.fif files, or both')
+    parser.add_argument('--fit-group-ica', action='store_true',
+                        help='Refit the condition\'s group ICA model; new subjects otherwise reuse the saved one')
+    args = parser.parse_args()
+
+    BIDS_ROOT = args.bids_root
+    DERIV_ROOT = os.path.join(BIDS_ROOT, 'derivatives')
+    jobs = find_jobs(BIDS_ROOT, args.condition)
+    if args.fit_group_ica or (ICA_MODE == 'group' and not os.path.exists(group_model_path(DERIV_ROOT, args.condition))):
+        print(f"Group ICA model saved to: {fit_group_ica(jobs, DERIV_ROOT, args.condition)}")
+    summary = run_jobs(jobs, BIDS_ROOT, DERIV_ROOT, args.condition, n_jobs=args.jobs, profile=args.profile,
+                       save_format=args.save_format)
 
+    print(summary.sort_values(['subject', 'file']).to_string(index=False))
+    print(summary.groupby('status')['seconds'].agg(['count', 'sum']).to_string())
+    if args.save_format in ('store', 'both') and (summary['status'] == 'ok').any():
+        print(f"Epoch store written to: {consolidate(store_dir_for(DERIV_ROOT, args.condition))}")
+    if args.profile:
+        print(aggregate_profiles(os.path.join(DERIV_ROOT, 'logs')).to_string())
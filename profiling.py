@@ -0,0 +1,81 @@
+import os, sys, json, glob, time, contextlib
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024  # Bytes on macOS, KiB on Linux
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _to_json(value):
+    # numpy scalars and arrays in stage records
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+def arrays(**named):
+    # Shape and size of the arrays a stage produced, for the stage record
+    info = {}
+    for name, array in named.items():
+        info[f'{name}_shape'] = list(array.shape)
+        info[f'{name}_mb'] = round(array.nbytes / 1024 ** 2, 2)
+    return info
+
+class StageProfiler:
+    def __init__(self, **context):
+        self.context = context
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        # Yields the stage record so the caller can add array sizes once they exist
+        record = dict(info, stage=name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.update(wall_s=round(time.perf_counter() - wall, 4), cpu_s=round(time.process_time() - cpu, 4),
+                          rss_mb=current_rss_mb(), peak_rss_mb=peak_rss_mb())
+            self.stages.append(record)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict(self.context, stages=self.stages), f, indent=2, default=_to_json)
+        os.replace(path + '.tmp', path)
+
+class NullProfiler:
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        yield {}
+
+def load_profiles(log_dir):
+    rows = []
+    for path in sorted(glob.glob(os.path.join(log_dir, '*_profile.json'))):
+        with open(path) as f:
+            log = json.load(f)
+        context = {k: v for k, v in log.items() if k != 'stages'}
+        rows += [dict(context, **stage) for stage in log['stages']]
+    return pd.DataFrame(rows)
+
+def aggregate_profiles(log_dir):
+    # Total and per-recording cost of every stage across the cohort, slowest first
+    profiles = load_profiles(log_dir)
+    if profiles.empty:
+        return profiles
+    per_file = profiles.groupby(['subject', 'file', 'stage'])[['wall_s', 'cpu_s']].sum().reset_index()
+    summary = per_file.groupby('stage').agg(files=('file', 'count'), wall_total_s=('wall_s', 'sum'),
+                                            wall_mean_s=('wall_s', 'mean'), wall_max_s=('wall_s', 'max'),
+                                            cpu_total_s=('cpu_s', 'sum'))
+    summary['peak_rss_mb'] = profiles.groupby('stage')['peak_rss_mb'].max()
+    return summary.sort_values('wall_total_s', ascending=False)
@@ -0,0 +1,52 @@
+import numpy as np
+
+# Thresholds are in the units of the recorded stream (microvolts for OpenBCI)
+PTP_THRESHOLD = 150.0  # Peak-to-peak above this on any good channel sends the epoch to ICA
+HF_BAND = 30.0  # Hz; power above this over total power is the high-frequency ratio
+HF_RATIO = 0.3  # High-frequency ratio above this (muscle, line noise) sends the epoch to ICA
+FLAT_TOLERANCE = 1e-2  # Sample-to-sample change below this counts as flat
+FLAT_SECONDS = 2.0  # A flat run this long marks the channel bad for the epoch
+RAIL_LEVEL = 187500.0 * 0.95  # Cyton ADC rails at +/-187500 uV (4.5 V reference, gain 24)
+RAIL_FRACTION = 0.01  # Fraction of railed samples that marks the channel bad for the epoch
+
+def screen_params():
+    # Every threshold that decides which epochs go to ICA and which channels are bad, for the manifest
+    return {'PTP_THRESHOLD': PTP_THRESHOLD, 'HF_BAND': HF_BAND, 'HF_RATIO': HF_RATIO, 'FLAT_TOLERANCE': FLAT_TOLERANCE,
+            'FLAT_SECONDS': FLAT_SECONDS, 'RAIL_LEVEL': RAIL_LEVEL, 'RAIL_FRACTION': RAIL_FRACTION}
+
+def rail_mask(data):
+    # Needs the unfiltered data: the high-pass removes the DC offset of a railed channel
+    return np.abs(data) >= RAIL_LEVEL
+
+def longest_run(mask):
+    # Length of the longest run of True along the last axis, for every row at once
+    if mask.shape[-1] == 0:
+        return np.zeros(mask.shape[:-1], dtype=np.int64)
+    positions = np.arange(mask.shape[-1])
+    last_false = np.maximum.accumulate(np.where(mask, -1, positions), axis=-1)
+    return (positions - last_false).max(axis=-1)
+
+def hf_ratio(data, sfreq):
+    power = np.abs(np.fft.rfft(data - data.mean(axis=-1, keepdims=True), axis=-1)) ** 2
+    freqs = np.fft.rfftfreq(data.shape[-1], 1 / sfreq)
+    total = power[..., freqs > 0].sum(axis=-1)
+    return power[..., freqs >= HF_BAND].sum(axis=-1) / np.maximum(total, np.finfo(float).tiny)
+
+def screen_epochs(epochs_data, lengths, sfreq, rail_epochs=None, min_good=2):
+    # Per epoch and channel metrics on the (n_channels, lengths[i]) windows from epoch_events.
+    # action per epoch: 'clean' skips ICA, 'ica' needs it, 'drop' has fewer than min_good usable channels.
+    n_events, n_channels = len(epochs_data), len(epochs_data[0]) if len(epochs_data) else 0
+    ptp, flat, railed, hf = (np.zeros((n_events, n_channels)) for _ in range(4))
+    for i in np.flatnonzero(lengths):
+        data = epochs_data[i]
+        ptp[i] = np.ptp(data, axis=-1)
+        flat[i] = longest_run(np.abs(np.diff(data, axis=-1)) < FLAT_TOLERANCE) / sfreq
+        hf[i] = hf_ratio(data, sfreq)
+        if rail_epochs is not None:
+            railed[i] = rail_epochs[i].mean(axis=-1)
+
+    bad = (flat >= FLAT_SECONDS) | (railed > RAIL_FRACTION)
+    noisy = ~bad & ((ptp > PTP_THRESHOLD) | (hf > HF_RATIO))
+    action = np.where(noisy.any(axis=1), 'ica', 'clean').astype(object)
+    action[((~bad).sum(axis=1) < min_good) | (lengths == 0)] = 'drop'
+    return {'ptp': ptp, 'flat_seconds': flat, 'rail_fraction': railed, 'hf_ratio': hf, 'bad': bad, 'action': action}
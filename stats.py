@@ -0,0 +1,110 @@
+import os, argparse
+import numpy as np
+import pandas as pd
+from scipy import stats as sp_stats
+from concurrent.futures import ProcessPoolExecutor
+from features import BANDS, band_power_table
+
+N_PERMUTATIONS = 5000
+PERM_BLOCK = 500  # Permutations per block; every block has its own child seed, so serial and parallel runs agree
+PERM_SEED = 97
+CLUSTER_P = 0.05  # Two-sided cluster-forming threshold on the t statistic
+
+def welch_t(data, labels):
+    # data (n_subjects, n_features), labels (n_perm, n_subjects) bool -> (n_perm, n_features) Welch t, group 1 - group 0
+    a = labels.astype(np.float64)
+    b = 1 - a
+    n_a, n_b = a.sum(axis=1, keepdims=True), b.sum(axis=1, keepdims=True)
+    mean_a, mean_b = a @ data / n_a, b @ data / n_b
+    sq = data ** 2
+    var_a = (a @ sq - n_a * mean_a ** 2) / (n_a - 1)
+    var_b = (b @ sq - n_b * mean_b ** 2) / (n_b - 1)
+    return (mean_a - mean_b) / np.sqrt(np.maximum(var_a / n_a + var_b / n_b, np.finfo(float).tiny))
+
+def cluster_masses(t, threshold):
+    # t (n_perm, n_rows, n_adjacent): clusters are same-sign supra-threshold runs along the last axis.
+    # Returns each cluster's permutation index, mass (sum of t) and a label array shaped like t (-1 outside clusters).
+    sign = np.where(t > threshold, 1, np.where(t < -threshold, -1, 0))
+    previous = np.concatenate([np.zeros(sign.shape[:-1] + (1,), dtype=sign.dtype), sign[..., :-1]], axis=-1)
+    starts = (sign != 0) & (sign != previous)
+    ids = np.cumsum(starts.ravel()) - 1
+    inside = sign.ravel() != 0
+    mass = np.bincount(ids[inside], weights=t.ravel()[inside], minlength=int(starts.sum()))
+    perm_of_cluster = np.nonzero(starts)[0]
+    return perm_of_cluster, mass, np.where(inside, ids, -1).reshape(t.shape)
+
+def max_cluster_mass(t, threshold):
+    perm, mass, _ = cluster_masses(t, threshold)
+    out = np.zeros(len(t))
+    np.maximum.at(out, perm, np.abs(mass))
+    return out
+
+def permutation_block(data, labels, n_perm, seed_seq, threshold, shape):
+    # One block of the null distribution: max |t| and max cluster mass per permutation
+    rng = np.random.default_rng(seed_seq)
+    perm_labels = rng.permuted(np.tile(labels, (n_perm, 1)), axis=1)
+    t = welch_t(data, perm_labels)
+    return np.abs(t).max(axis=1), max_cluster_mass(t.reshape((n_perm,) + shape), threshold)
+
+def permutation_test(data, labels, n_permutations=N_PERMUTATIONS, seed=PERM_SEED, n_jobs=1, cluster_p=CLUSTER_P,
+                     block=PERM_BLOCK):
+    # data (n_subjects, *feature_shape), clusters along the last feature axis; labels: True for group 1.
+    # Returns observed t, max-t corrected p per feature and cluster-level p values.
+    labels = np.asarray(labels, dtype=bool)
+    shape = data.shape[1:] if data.ndim > 2 else (1,) + data.shape[1:]
+    flat = data.reshape(len(data), -1).astype(np.float64)
+    threshold = sp_stats.t.ppf(1 - cluster_p / 2, len(labels) - 2)
+
+    sizes = [min(block, n_permutations - start) for start in range(0, n_permutations, block)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(flat, labels, size, seed_seq, threshold, shape) for size, seed_seq in zip(sizes, seeds)]
+    if n_jobs == 1:
+        results = [permutation_block(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(permutation_block, *zip(*args)))
+    null_t = np.concatenate([r[0] for r in results])
+    null_mass = np.concatenate([r[1] for r in results])
+
+    t_obs = welch_t(flat, labels[None])
+    _, masses, cluster_ids = cluster_masses(t_obs.reshape((1,) + shape), threshold)
+    p_t = (1 + (null_t[:, None] >= np.abs(t_obs)).sum(axis=0)) / (n_permutations + 1)
+    p_clusters = (1 + (null_mass[:, None] >= np.abs(masses)).sum(axis=0)) / (n_permutations + 1)
+    return {'t': t_obs.reshape(data.shape[1:]), 'p_maxt': p_t.reshape(data.shape[1:]),
+            'clusters': cluster_ids.reshape(data.shape[1:]), 'cluster_mass': masses, 'cluster_p': p_clusters}
+
+def band_power_matrix(deriv_root, conditions):
+    # Subject x channel x band matrix of log10 band power averaged over ads, bands in frequency order
+    frames = []
+    for condition in conditions:
+        table = band_power_table(deriv_root, condition)
+        frames.append(table.assign(subject=condition + '/' + table['subject'].astype(str)))
+    table = pd.concat(frames, ignore_index=True)
+    table['power'] = np.log10(table['power'])
+    cube = table.groupby(['subject', 'channel', 'band'])['power'].mean().unstack('band')[list(BANDS)]
+    subjects = cube.index.get_level_values('subject').unique()
+    channels = cube.index.get_level_values('channel').unique()
+    return subjects, list(channels), cube.to_numpy().reshape(len(subjects), len(channels), len(BANDS))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cluster permutation test of band power, TV vs digital conditions')
+    parser.add_argument('--bids-root', default='../')
+    parser.add_argument('--tv', nargs='+', required=True, help='TV conditions, e.g. lego bigmood cnn foxnews nfl')
+    parser.add_argument('--digital', nargs='+', required=True, help='Smartphone/YouTube conditions')
+    parser.add_argument('--permutations', type=int, default=N_PERMUTATIONS)
+    parser.add_argument('--seed', type=int, default=PERM_SEED)
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args()
+
+    deriv_root = os.path.join(args.bids_root, 'derivatives')
+    tv_subjects, channels, tv = band_power_matrix(deriv_root, args.tv)
+    digital_subjects, digital_channels, digital = band_power_matrix(deriv_root, args.digital)
+    if channels != digital_channels:
+        raise ValueError(f'Channel mismatch between groups: {channels} vs {digital_channels}')
+    result = permutation_test(np.concatenate([tv, digital]), np.r_[np.ones(len(tv), bool), np.zeros(len(digital), bool)],
+                              args.permutations, args.seed, args.jobs)
+    print(f"{len(tv)} TV vs {len(digital)} digital subjects, {args.permutations} permutations")
+    print(pd.DataFrame(result['t'], index=channels, columns=list(BANDS)).round(2).to_string())
+    for cluster, (mass, p) in enumerate(zip(result['cluster_mass'], result['cluster_p'])):
+        channel, bands = np.nonzero(result['clusters'] == cluster)
+        print(f"Cluster {cluster}: {channels[channel[0]]} {[list(BANDS)[b] for b in bands]} mass {mass:.2f} p={p:.4f}")
@@ -0,0 +1,119 @@
+import os, json, argparse
+import numpy as np
+import pandas as pd
+from scipy import fft as sp_fft
+from epoch_store import EpochStore, store_dir_for
+from features import store_hash
+
+TFR_FREQS = np.arange(4.0, 31.0, 1.0)
+N_CYCLES = 7.0
+DECIM = 5  # 250 Hz -> 50 Hz; power envelopes are smooth, so plain slicing after convolution is enough
+TFR_OUTPUT = 'power'  # 'power' (float32) or 'complex' (complex64)
+TFR_CHUNK = 2**28  # Bytes of complex128 spectra held at once, bounds memory on long show epochs
+
+def tfr_dir_for(deriv_root, condition):
+    return os.path.join(deriv_root, 'tfr', condition)
+
+def morlet_wavelets(sfreq, freqs=TFR_FREQS, n_cycles=N_CYCLES):
+    # Complex Morlet wavelets out to 5 standard deviations, sampled and normalised as mne.time_frequency.morlet
+    wavelets = []
+    for freq in freqs:
+        sigma = n_cycles / (2 * np.pi * freq)
+        t = np.arange(0, 5 * sigma, 1 / sfreq)
+        t = np.r_[-t[:0:-1], t]  # Symmetric about t=0 and odd length, so the 'same' offset below is exact
+        w = np.exp(2j * np.pi * freq * t) * np.exp(-t ** 2 / (2 * sigma ** 2))
+        wavelets.append(w / (np.sqrt(0.5) * np.linalg.norm(w)))
+    return wavelets
+
+def wavelet_spectra(wavelets, nfft):
+    return np.stack([sp_fft.fft(w, nfft) for w in wavelets])
+
+def morlet_tfr(data, sfreq, freqs=TFR_FREQS, n_cycles=N_CYCLES, decim=DECIM, output=TFR_OUTPUT, chunk=TFR_CHUNK):
+    # data (n_epochs, n_channels, n_times) -> (n_epochs, n_channels, n_freqs, ceil(n_times / decim)).
+    # One FFT per signal, then frequencies in blocks so the product spectra stay under chunk bytes.
+    out = np.empty(data.shape[:2] + (len(freqs), len(range(0, data.shape[-1], decim))),
+                   dtype=np.float32 if output == 'power' else np.complex64)
+    for block, tfr in _tfr_blocks(data, sfreq, freqs, n_cycles, decim, output, chunk):
+        out[:, :, block] = tfr
+    return out
+
+def _tfr_blocks(data, sfreq, freqs, n_cycles, decim, output, chunk):
+    n_times = data.shape[-1]
+    wavelets = morlet_wavelets(sfreq, freqs, n_cycles)
+    longest = max(len(w) for w in wavelets)
+    nfft = sp_fft.next_fast_len(n_times + longest - 1)
+    spectra = sp_fft.fft(data, nfft, axis=-1, workers=-1)[:, :, None, :]
+    n_signals = data.shape[0] * data.shape[1]
+    per_block = max(1, chunk // (n_signals * nfft * 16))
+    for start in range(0, len(freqs), per_block):
+        block = slice(start, min(start + per_block, len(freqs)))
+        kernels = wavelet_spectra(wavelets[block], nfft)
+        conv = sp_fft.ifft(spectra * kernels, axis=-1, workers=-1)
+        # 'same' alignment per wavelet, then decimate
+        tfr = np.stack([conv[:, :, i, (len(w) - 1) // 2:(len(w) - 1) // 2 + n_times:decim]
+                        for i, w in enumerate(wavelets[block])], axis=2)
+        yield block, (np.abs(tfr) ** 2).astype(np.float32) if output == 'power' else tfr.astype(np.complex64)
+
+def tfr_batches(store, rows, chunk=TFR_CHUNK):
+    # Equal-length epochs stacked so that their spectra fit in chunk bytes (2 * n_times bounds the FFT length,
+    # the longest wavelet is a few seconds against epochs of 15 s and more)
+    for n_times, group in rows.groupby(rows['n_times'].to_numpy()):
+        nfft = sp_fft.next_fast_len(int(n_times) * 2)
+        per_batch = max(1, chunk // (len(store.ch_names) * nfft * 16))
+        for start in range(0, len(group), per_batch):
+            batch = group.iloc[start:start + per_batch]
+            yield batch, np.stack([store.get(row) for _, row in batch.iterrows()]).astype(np.float64)
+
+def epoch_name(row):
+    return f"sub-{row['subject']}_event-{int(row['event'])}_tfr.npy"
+
+def compute_condition_tfr(deriv_root, condition, freqs=TFR_FREQS, n_cycles=N_CYCLES, decim=DECIM, output=TFR_OUTPUT,
+                          chunk=TFR_CHUNK, force=False):
+    # One (n_channels, n_freqs, n_times) .npy per epoch under derivatives/tfr/<condition>/, written block by block
+    store_dir = store_dir_for(deriv_root, condition)
+    out_dir = tfr_dir_for(deriv_root, condition)
+    # 'symmetric' marks the MNE-sampled wavelets, so TFRs written with the earlier one-sample offset are redone
+    key = store_hash(store_dir, list(freqs), n_cycles, decim, output, 'symmetric')
+    info_path = os.path.join(out_dir, 'info.json')
+    if not force and os.path.exists(info_path):
+        with open(info_path) as f:
+            if json.load(f).get('key') == key:
+                print(f"TFR for {condition} is current")
+                return out_dir
+
+    store = EpochStore(store_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    dtype = np.float32 if output == 'power' else np.complex64
+    rows = []
+    for batch, data in tfr_batches(store, store.index, chunk):
+        n_out = len(range(0, data.shape[-1], decim))
+        outputs = [np.lib.format.open_memmap(os.path.join(out_dir, epoch_name(row)), mode='w+', dtype=dtype,
+                                             shape=(len(store.ch_names), len(freqs), n_out))
+                   for _, row in batch.iterrows()]
+        for block, tfr in _tfr_blocks(data, store.sfreq, freqs, n_cycles, decim, output, chunk):
+            for out, epoch_tfr in zip(outputs, tfr):
+                out[:, block] = epoch_tfr
+        for out in outputs:
+            out.flush()
+        del outputs
+        rows += [dict(row[['subject', 'event', 'marker']], file=epoch_name(row), n_times=n_out)
+                 for _, row in batch.iterrows()]
+        print(f"TFR: {len(rows)}/{len(store)} epochs")
+
+    pd.DataFrame(rows).to_csv(os.path.join(out_dir, 'index.csv'), index=False)
+    with open(info_path, 'w') as f:
+        json.dump({'key': key, 'ch_names': store.ch_names, 'freqs': list(map(float, freqs)), 'n_cycles': n_cycles,
+                   'sfreq': store.sfreq / decim, 'tmin': store.tmin, 'output': output}, f)
+    return out_dir
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Morlet time-frequency decomposition of every stored epoch')
+    parser.add_argument('--bids-root', default='../')
+    parser.add_argument('--condition', default='bigmood')
+    parser.add_argument('--output', default=TFR_OUTPUT, choices=['power', 'complex'])
+    parser.add_argument('--decim', type=int, default=DECIM)
+    parser.add_argument('--force', action='store_true', help='Recompute even if the TFR directory is current')
+    args = parser.parse_args()
+
+    compute_condition_tfr(os.path.join(args.bids_root, 'derivatives'), args.condition, decim=args.decim,
+                          output=args.output, force=args.force)
@@ -0,0 +1,158 @@
+import os, json, struct, hashlib
+import pandas as pd
+
+SHOW_LISTS = ('lists_shows.xlsx', 'lists_shows2.xlsx')  # 'shows', 'marker': one row per show, picked per condition
+AD_LISTS = ('lists.xlsx',)  # 'videos', 'marker': every row is played
+CACHE_FILE = 'video_durations.json'  # Kept next to the PsychoPy lists, keyed by video fingerprint
+FINGERPRINT_BYTES = 1 << 20
+
+def _boxes(f, start, end):
+    # Iterate ISO-BMFF boxes between start and end as (type, payload start, box end)
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            break
+        yield box_type, position + header, position + size
+        position += size
+
+def mp4_duration(path):
+    # Duration in seconds from the movie header (moov/mvhd); only box headers are read, no frames decoded
+    with open(path, 'rb') as f:
+        for box_type, start, end in _boxes(f, 0, os.path.getsize(path)):
+            if box_type != b'moov':
+                continue
+            for child_type, child_start, _ in _boxes(f, start, end):
+                if child_type == b'mvhd':
+                    f.seek(child_start)
+                    version = f.read(4)[0]
+                    if version == 1:
+                        _, _, timescale, duration = struct.unpack('>QQIQ', f.read(28))
+                    else:
+                        _, _, timescale, duration = struct.unpack('>IIII', f.read(16))
+                    return duration / timescale
+    raise ValueError('No movie header found in video: ' + path)
+
+def _child(f, start, end, wanted):
+    for box_type, child_start, child_end in _boxes(f, start, end):
+        if box_type == wanted:
+            return child_start, child_end
+    return None
+
+def mp4_frame_rate(path):
+    # Frames per second of the first video track: sample count from stts over the media duration from mdhd
+    with open(path, 'rb') as f:
+        moov = _child(f, 0, os.path.getsize(path), b'moov')
+        for box_type, start, end in _boxes(f, *moov) if moov else ():
+            mdia = _child(f, start, end, b'mdia') if box_type == b'trak' else None
+            hdlr = _child(f, *mdia, b'hdlr') if mdia else None
+            if not hdlr:
+                continue
+            f.seek(hdlr[0] + 8)
+            if f.read(4) != b'vide':
+                continue
+            mdhd = _child(f, *mdia, b'mdhd')
+            f.seek(mdhd[0])
+            version = f.read(4)[0]
+            if version == 1:
+                _, _, timescale, duration = struct.unpack('>QQIQ', f.read(28))
+            else:
+                _, _, timescale, duration = struct.unpack('>IIII', f.read(16))
+            minf = _child(f, *mdia, b'minf')
+            stbl = _child(f, *minf, b'stbl') if minf else None
+            stts = _child(f, *stbl, b'stts') if stbl else None
+            if not stts or not duration:
+                break
+            f.seek(stts[0] + 4)
+            n_entries = struct.unpack('>I', f.read(4))[0]
+            counts = struct.unpack(f'>{2 * n_entries}I', f.read(8 * n_entries))[::2]
+            return sum(counts) * timescale / duration
+    raise ValueError('No video track found in video: ' + path)
+
+def video_fingerprint(path):
+    # Size plus the first and last megabyte: identifies the file without hashing the whole video
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    digest.update(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        f.seek(max(0, size - FINGERPRINT_BYTES))
+        digest.update(f.read(FINGERPRINT_BYTES))
+    return digest.hexdigest()
+
+def load_cache(list_dir):
+    path = os.path.join(list_dir, CACHE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_cache(list_dir, cache):
+    with open(os.path.join(list_dir, CACHE_FILE), 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+def video_duration(path, cache):
+    key = video_fingerprint(path)
+    if key not in cache:
+        cache[key] = {'file': os.path.basename(path), 'duration': mp4_duration(path)}
+    return cache[key]['duration']
+
+def video_frame_rate(path, cache):
+    key = video_fingerprint(path)
+    entry = cache.setdefault(key, {'file': os.path.basename(path), 'duration': mp4_duration(path)})
+    if 'fps' not in entry:
+        entry['fps'] = mp4_frame_rate(path)
+    return entry['fps']
+
+def condition_playlist(list_dir, show=None):
+    # (marker, video path) for every video a condition plays; show picks the row of the shows lists
+    # whose file name starts with it (e.g. 'LEGO', 'BigMood', 'FoxNews')
+    playlist = []
+    for name in AD_LISTS:
+        path = os.path.join(list_dir, name)
+        if os.path.exists(path):
+            playlist += [(str(int(r['marker'])), r['videos']) for _, r in pd.read_excel(path).iterrows()]
+    if show is not None:
+        for name in SHOW_LISTS:
+            path = os.path.join(list_dir, name)
+            if not os.path.exists(path):
+                continue
+            shows = pd.read_excel(path)
+            match = shows[shows['shows'].map(lambda v: os.path.basename(v).lower().startswith(show.lower()))]
+            if match.empty:
+                raise ValueError(f'No show matching {show} in {path}')
+            playlist.append((str(int(match.iloc[0]['marker'])), match.iloc[0]['shows']))
+    return playlist
+
+def condition_durations(list_dir, show=None):
+    # marker -> duration in seconds, ready for events.extract_events
+    cache = load_cache(list_dir)
+    durations = {}
+    for marker, video in condition_playlist(list_dir, show):
+        path = os.path.join(list_dir, video)
+        if not os.path.exists(path):
+            print(f"Video not found, marker {marker} will be skipped: {path}")
+            continue
+        durations[marker] = video_duration(path, cache)
+    save_cache(list_dir, cache)
+    if not durations:
+        raise FileNotFoundError(f'No video of the {show or "ads"} playlist found under {list_dir}')
+    return durations
+
+def condition_frame_rates(list_dir, show=None):
+    # marker -> frames per second, for aligning EEG features to the video timeline
+    cache = load_cache(list_dir)
+    rates = {}
+    for marker, video in condition_playlist(list_dir, show):
+        path = os.path.join(list_dir, video)
+        if os.path.exists(path):
+            rates[marker] = video_frame_rate(path, cache)
+    save_cache(list_dir, cache)
+    return rates
@@ -0,0 +1,238 @@
+import os, io, json, struct
+import numpy as np
+import xml.etree.ElementTree as ET
+from pyxdf import load_xdf
+
+CACHE_SUFFIX = '.cache'  # Sidecar directory next to each .xdf file
+META_FILE = 'meta.json'
+CHANNEL_FORMATS = {'float32': np.float32, 'double64': np.float64, 'int8': np.int8,
+                   'int16': np.int16, 'int32': np.int32, 'int64': np.int64}
+JITTER_BREAK_SECONDS = 1.0  # Same segment-break rule as pyxdf's dejittering
+JITTER_BREAK_SAMPLES = 500
+
+def cache_dir_for(file_path):
+    return file_path + CACHE_SUFFIX
+
+def source_stamp(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _to_json(value):
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+def write_cache(file_path, streams=None):
+    if streams is None:
+        streams, _ = load_xdf(file_path)
+    cache_dir = cache_dir_for(file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    meta = {'source': source_stamp(file_path), 'streams': []}
+    for index, stream in enumerate(streams):
+        entry = {'info': stream['info'], 'footer': stream.get('footer'),
+                 'clock_times': list(stream.get('clock_times', [])),
+                 'clock_values': list(stream.get('clock_values', []))}
+        np.save(os.path.join(cache_dir, f'stream-{index}_time_stamps.npy'),
+                np.asarray(stream['time_stamps'], dtype=np.float64))
+        if isinstance(stream['time_series'], list):  # String markers stay in the JSON
+            entry['time_series'] = stream['time_series']
+        else:
+            np.save(os.path.join(cache_dir, f'stream-{index}_time_series.npy'),
+                    np.asarray(stream['time_series'], dtype=np.float32))
+        meta['streams'].append(entry)
+
+    # The metadata is written last so an interrupted conversion never looks like a valid cache
+    tmp_path = os.path.join(cache_dir, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, default=_to_json)
+    os.replace(tmp_path, os.path.join(cache_dir, META_FILE))
+
+def read_cache(file_path):
+    meta_path = os.path.join(cache_dir_for(file_path), META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['source'] != source_stamp(file_path):
+        return None
+
+    cache_dir = cache_dir_for(file_path)
+    streams = []
+    for index, entry in enumerate(meta['streams']):
+        stream = dict(entry)
+        stream['time_stamps'] = np.load(os.path.join(cache_dir, f'stream-{index}_time_stamps.npy'), mmap_mode='r')
+        if 'time_series' not in stream:
+            stream['time_series'] = np.load(os.path.join(cache_dir, f'stream-{index}_time_series.npy'), mmap_mode='r')
+        stream['clock_times'] = np.asarray(stream['clock_times'])
+        stream['clock_values'] = np.asarray(stream['clock_values'])
+        streams.append(stream)
+    return streams
+
+def load_xdf_cached(file_path):
+    streams = read_cache(file_path)
+    if streams is not None:
+        return streams
+
+    streams, _ = load_xdf(file_path)
+    try:
+        write_cache(file_path, streams)
+    except OSError as e:
+        print(f"Could not write XDF cache for {file_path}: {e}")
+        return streams
+    return read_cache(file_path)
+
+def _read_varlen_int(f):
+    nbytes = f.read(1)
+    if nbytes == b'\x01':
+        return ord(f.read(1))
+    elif nbytes == b'\x04':
+        return struct.unpack('<I', f.read(4))[0]
+    elif nbytes == b'\x08':
+        return struct.unpack('<Q', f.read(8))[0]
+    elif not nbytes:
+        raise EOFError
+    raise ValueError('Invalid variable-length integer in XDF chunk')
+
+def _xml2dict(element):
+    # Same nested layout pyxdf uses: every child element becomes a list of dicts or strings
+    children = list(element)
+    if not children:
+        return element.text
+    result = {}
+    for child in children:
+        result.setdefault(child.tag, []).append(_xml2dict(child))
+    return result
+
+def channel_labels(info):
+    if not info.get('desc') or not info['desc'][0] or 'channels' not in info['desc'][0]:
+        return [str(i) for i in range(int(info['channel_count'][0]))]
+    return [ch['label'][0] for ch in info['desc'][0]['channels'][0]['channel']]
+
+def _decode_numeric(buf, n_samples, n_channels, dtype, columns):
+    value_dtype = np.dtype(dtype).newbyteorder('<')
+    # Fast path: when every sample in the chunk carries a time stamp (or none does) the records
+    # have a fixed size and the whole chunk is decoded with one frombuffer call
+    for has_stamp in (True, False):
+        fields = [('flag', 'u1')] + ([('stamp', '<f8')] if has_stamp else []) + [('values', value_dtype, (n_channels,))]
+        record = np.dtype(fields)
+        if record.itemsize * n_samples == len(buf):
+            records = np.frombuffer(buf, record)
+            if np.all(records['flag'] == (8 if has_stamp else 0)):
+                stamps = records['stamp'] if has_stamp else np.full(n_samples, np.nan)
+                return stamps, records['values'][:, columns].astype(np.float32)
+
+    f = io.BytesIO(buf)
+    stamps = np.full(n_samples, np.nan)
+    values = np.empty((n_samples, len(columns)), dtype=np.float32)
+    for i in range(n_samples):
+        if f.read(1) == b'\x08':
+            stamps[i] = struct.unpack('<d', f.read(8))[0]
+        values[i] = np.frombuffer(f.read(n_channels * value_dtype.itemsize), value_dtype)[columns]
+    return stamps, values
+
+def _decode_strings(buf, n_samples, n_channels, columns):
+    f = io.BytesIO(buf)
+    stamps = np.full(n_samples, np.nan)
+    values = []
+    for i in range(n_samples):
+        if f.read(1) == b'\x08':
+            stamps[i] = struct.unpack('<d', f.read(8))[0]
+        sample = [f.read(_read_varlen_int(f)).decode('utf-8', errors='replace') for _ in range(n_channels)]
+        values.append([sample[c] for c in columns])
+    return stamps, values
+
+def _fill_stamps(stamps, srate):
+    # Samples without a time stamp continue from the last stamped sample at the nominal rate
+    missing = np.isnan(stamps)
+    if not missing.any() or missing.all() or srate <= 0:
+        return stamps
+    positions = np.arange(len(stamps))
+    last = np.maximum.accumulate(np.where(missing, 0, positions))
+    filled = stamps[last] + (positions - last) / srate
+    return np.where(missing, filled, stamps)
+
+def _clock_sync(stamps, clock_times, clock_values):
+    if len(clock_times) == 0:
+        return stamps
+    if len(clock_times) == 1:
+        return stamps + clock_values[0]
+    slope, intercept = np.polyfit(clock_times, clock_values, 1)
+    return stamps + (intercept + slope * stamps)
+
+def _dejitter(stamps, srate):
+    if srate <= 0 or len(stamps) < 2:
+        return stamps
+    threshold = max(JITTER_BREAK_SECONDS, JITTER_BREAK_SAMPLES / srate)
+    bounds = np.concatenate([[0], np.flatnonzero(np.abs(np.diff(stamps)) > threshold) + 1, [len(stamps)]])
+    result = np.empty_like(stamps)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        positions = np.arange(stop - start)
+        if len(positions) < 2:
+            result[start:stop] = stamps[start:stop]
+            continue
+        slope, intercept = np.polyfit(positions, stamps[start:stop], 1)
+        result[start:stop] = intercept + slope * positions
+    return result
+
+def load_stream(file_path, stream_type='EEG', channels=None, dejitter=True):
+    # Walk the chunk headers once, decoding only the samples of the first stream of stream_type
+    # and only the requested channels (indices or labels); all other chunks are skipped with a seek
+    stream = None
+    stamps, values = [], []
+    clock_times, clock_values = [], []
+    with open(file_path, 'rb') as f:
+        if f.read(4) != b'XDF:':
+            raise ValueError('Not an XDF file: ' + file_path)
+        while True:
+            try:
+                length = _read_varlen_int(f)
+                tag = struct.unpack('<H', f.read(2))[0]
+                end = f.tell() + length - 2
+                stream_id = struct.unpack('<I', f.read(4))[0] if tag in (2, 3, 4, 6) else None
+
+                if tag == 2 and stream is None:
+                    info = _xml2dict(ET.fromstring(f.read(end - f.tell())))
+                    if info['type'][0] == stream_type:
+                        labels = channel_labels(info)
+                        if channels is None:
+                            columns = list(range(len(labels)))
+                        else:
+                            columns = [labels.index(c) if isinstance(c, str) else int(c) for c in channels]
+                            columns = [c for c in columns if c < len(labels)]
+                        stream = {'id': stream_id, 'info': info, 'columns': columns,
+                                  'format': info['channel_format'][0], 'n_channels': int(info['channel_count'][0])}
+                elif stream is not None and stream_id == stream['id'] and tag == 3:
+                    n_samples = _read_varlen_int(f)
+                    buf = f.read(end - f.tell())
+                    if stream['format'] == 'string':
+                        chunk = _decode_strings(buf, n_samples, stream['n_channels'], stream['columns'])
+                    else:
+                        chunk = _decode_numeric(buf, n_samples, stream['n_channels'],
+                                                CHANNEL_FORMATS[stream['format']], stream['columns'])
+                    stamps.append(chunk[0])
+                    values.append(chunk[1])
+                elif stream is not None and stream_id == stream['id'] and tag == 4:
+                    collection_time, offset_value = struct.unpack('<dd', f.read(16))
+                    clock_times.append(collection_time)
+                    clock_values.append(offset_value)
+                f.seek(end)
+            except EOFError:
+                break
+            except struct.error:
+                print(f"Truncated chunk in {file_path}; keeping the samples read so far")
+                break
+
+    if stream is None:
+        raise ValueError(f'No {stream_type} stream found in file: ' + file_path)
+
+    srate = float(stream['info']['nominal_srate'][0])
+    time_stamps = np.concatenate(stamps) if stamps else np.empty(0)
+    time_stamps = _clock_sync(_fill_stamps(time_stamps, srate), np.asarray(clock_times), np.asarray(clock_values))
+    if dejitter:
+        time_stamps = _dejitter(time_stamps, srate)
+    if stream['format'] == 'string':
+        time_series = [sample for chunk in values for sample in chunk]
+    else:
+        time_series = np.concatenate(values) if values else np.empty((0, len(stream['columns'])), dtype=np.float32)
+    return {'info': stream['info'], 'time_series': time_series, 'time_stamps': time_stamps,
+            'clock_times': np.asarray(clock_times), 'clock_values': np.asarray(clock_values),
+            'channels': [channel_labels(stream['info'])[c] for c in stream['columns']]}